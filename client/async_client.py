@@ -0,0 +1,126 @@
+#
+# asyncio version of the client Game API, so a single process can drive many player sessions at once.
+# It has the same protocol as client.Game, without the interactive parts (menus are returned, not printed).
+#
+
+import asyncio
+
+import aiohttp
+
+import client
+
+
+def createHttpSession():
+    # a single pooled session is meant to be shared by all the AsyncGames of a process
+    connector = aiohttp.TCPConnector(limit=client.connectionPoolSize, keepalive_timeout=30)
+    connectTimeout, readTimeout = client.requestTimeout
+    timeout = aiohttp.ClientTimeout(sock_connect=connectTimeout, sock_read=readTimeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class AsyncGame:
+    def __init__(self, httpSession, useMsgpack=False):
+        if useMsgpack and client.msgpack is None:
+            raise ImportError("useMsgpack needs the msgpack package")
+        self.httpSession = httpSession
+        self.useMsgpack = useMsgpack
+        self.sessionToken = None
+
+    async def sendRequestToServer(self, method, path, body=None):
+        # like client.Game, only connection failures are retried
+        if body is not None:
+            headers, data = client.encodeRequest(body, self.useMsgpack)
+        else:
+            headers, data = {'Accept': client.MSGPACK_MIMETYPE if self.useMsgpack else 'application/json'}, None
+        for attempt in range(client.maxRetries + 1):
+            try:
+                async with self.httpSession.request(method, client.serverAddress + path,
+                                                    headers=headers, data=data) as response:
+                    return client.decodeResponse(response.headers.get('Content-Type'), await response.read())
+            except aiohttp.ClientConnectorError:
+                if attempt == client.maxRetries:
+                    raise
+                await asyncio.sleep(client.retryBackoff * (2 ** attempt))
+
+    async def sendPostRequestToServer(self, wantedAction, body):
+        return await self.sendRequestToServer("POST", "/invokeAction/" + wantedAction, body)
+
+    async def sendGetRequestToServer(self, wantedAction):
+        return await self.sendRequestToServer("GET", "/invokeAction/" + wantedAction)
+
+    async def sendBatchRequestToServer(self, entries):
+        return await self.sendRequestToServer("POST", "/invokeBatch", entries)
+
+    def getAuthenticatedBody(self, loginData, body):
+        if self.sessionToken is not None:
+            authData = {"sessionToken": self.sessionToken}
+        else:
+            authData = loginData
+        if body is None:
+            return authData
+        return dict(body, loginData=authData)
+
+    def isSessionExpired(self, answer):
+        return answer.get("message") == "SESSION EXPIRED" and self.sessionToken is not None
+
+    async def sendAuthenticatedRequest(self, wantedAction, loginData, body=None):
+        while True:
+            answer = await self.sendPostRequestToServer(wantedAction, self.getAuthenticatedBody(loginData, body))
+            if self.isSessionExpired(answer):
+                self.sessionToken = None
+                await self.login(loginData)
+                continue
+            return answer
+
+    async def sendAuthenticatedBatch(self, loginData, actions):
+        # actions are (action, body) pairs, each is authenticated like in sendAuthenticatedRequest.
+        # only the entries that found the session expired are sent again, the others were done
+        answers = [None] * len(actions)
+        pending = list(range(len(actions)))
+        while pending:
+            pendingAnswers = await self.sendBatchRequestToServer([
+                {"action": actions[i][0], "body": self.getAuthenticatedBody(loginData, actions[i][1])}
+                for i in pending
+            ])
+            expired = []
+            for i, answer in zip(pending, pendingAnswers):
+                answers[i] = answer
+                if self.isSessionExpired(answer):
+                    expired.append(i)
+            if expired:
+                self.sessionToken = None
+                await self.login(loginData)
+            pending = expired
+        return answers
+
+    async def login(self, loginData):
+        details = await self.sendPostRequestToServer("login", loginData)
+
+        if details["status"] == "FAILURE":
+            raise client.LoginError(details["message"])
+
+        self.sessionToken = details.get("sessionToken")
+        return details
+
+    async def getQuestionsFromServer(self):
+        return await self.sendGetRequestToServer("getFormForNewPlayer")
+
+    async def createPlayer(self, playerData):
+        response = await self.sendPostRequestToServer("createNewPlayer", playerData)
+        if response["status"] == "FAILURE":
+            raise client.ServerError("An unknown error has occurred")
+        self.sessionToken = response.get("sessionToken")
+        return response
+
+    async def getRelevantMenu(self, loginData):
+        return await self.sendAuthenticatedRequest("getRelevantMenu", loginData)
+
+    async def getPlayerByLoginData(self, loginData):
+        return await self.sendAuthenticatedRequest("getPlayerByLoginData", loginData)
+
+    async def handleChoice(self, loginData, choice):
+        # returns the answer of the choice and the next menu, which are fetched in a single round trip
+        return await self.sendAuthenticatedBatch(loginData, [
+            ("handleChoice", {"choice": choice}),
+            ("getRelevantMenu", None)
+        ])
@@ -1,202 +1,407 @@
-#
-# API 1st
-# > Think about Edge cases
-# > Make sure it's a PARAMETER
-#
-
-import json
-import sys
-import requests
-import getpass
-
-# Game Class + Game Exceptions --> world.py
-
-# Player --> player.py
-
-# client.py <-- Init Player, World, Run.
-
-# GitLab <--
-
-serverAddress = "http://127.0.0.1:8081"
-
-
-class GameException(Exception):
-    def __init__(self, reason):
-        self.reason = reason
-
-    def __str__(self):
-        return f"In Game Exception: {self.reason}"
-
-
-class IllegalChoice(GameException):
-    pass
-
-
-class IllegalInput(GameException):
-    pass
-
-
-class NoSuchPlayer(GameException):
-    pass
-
-
-class LoginError(GameException):
-    pass
-
-
-class ServerError(GameException):
-    pass
-
-
-class Game:
-    def sendPostRequestToServer(self, wantedAction, body):
-        return requests.post(url=(serverAddress + "/invokeAction/" + wantedAction),
-                             headers={'Accept': 'application/json'},
-                             json=body).json()
-
-    def sendGetRequestToServer(self, wantedAction):
-        return requests.get(url=(serverAddress + "/invokeAction/" + wantedAction)).json()
-
-    def __init__(self):
-        pass
-
-    def login(self, loginData):
-        details = self.sendPostRequestToServer("login", loginData)
-
-        if details["status"] == "FAILURE":
-            raise LoginError(details["message"])
-
-        return details
-
-    def reformatTime(self, hour):
-        return str(hour).zfill(2) + ":00"
-
-    def getRelevantMenu(self, loginData):
-
-        answer = self.sendPostRequestToServer("getRelevantMenu", loginData)
-        menu = answer["options"]
-        name = answer["name"]
-        time = answer["time"]
-        print(f"Hello {name}, it's {time} o'clock. what would you like to do?")
-        for i in range(len(menu)):
-            print(f"{str(i + 1)}. {menu[i]['string']}")
-        print("To show player details enter *")
-
-        choice = input()
-        if self.isValidMenuChoice(choice, menu):
-            if choice == '*':
-                details = self.sendPostRequestToServer("getPlayerByLoginData", loginData)
-                print(json.dumps(details, indent=4, sort_keys=False))
-            else:
-                self.sendPostRequestToServer("handleChoice", {
-                    "loginData": loginData,
-                    "choice": menu[int(choice) - 1]["literal"]
-                })
-        else:
-            raise IllegalChoice("Illegal choice")
-
-    def isValidMenuChoice(self, choice, options):
-        if (choice == '*') | (choice == '#'):
-            return True
-        elif choice.isnumeric() and int(choice) <= len(options):
-            return True
-        return False
-
-    def validateInput(self, givenInput, inputType):
-        answer = self.sendPostRequestToServer("validateSingleInput", {
-            "givenInput": givenInput,
-            "type": inputType,
-        })
-
-        if answer["status"] == "FAILURE":
-            raise IllegalChoice(answer["message"])
-
-        return givenInput
-
-    def getQuestionsFromServer(self):
-        return self.sendGetRequestToServer("getFormForNewPlayer")
-
-    def createPlayer(self, playerData):
-        response = self.sendPostRequestToServer("createNewPlayer", playerData)
-        if response["status"] == "FAILURE":
-            raise ServerError("An unknown error has occurred")
-        return playerData["username"], playerData["password"]
-
-    def buildPlayer(self):
-        # Initialize as None for checking
-        player = {}
-        questions = self.getQuestionsFromServer()
-
-        while True:
-            try:
-                for question in questions:
-                    key = question["name"]
-                    questionText = question["question"]
-                    inputType = question["type"]
-                    try:
-                        if player.get(key, None) is None:
-                            if inputType == "PASSWORD":
-                                while True:
-                                    print(questionText)
-                                    password = getpass.getpass()
-                                    print("Re-enter password:")
-                                    reEnterPassword = getpass.getpass()
-                                    if password != reEnterPassword:
-                                        print("Passwords don't match!")
-                                    else:
-                                        break
-                                player[key] = self.validateInput(password, inputType)
-                            else:
-                                player[key] = self.validateInput(input(questionText + "\n"), inputType)
-                    except IllegalChoice as e:
-                        print(e.reason)
-                break
-
-            except IllegalInput:
-                print("Illegal input.")
-
-        return self.createPlayer(player)
-
-    def getMenuForPlayer(self, loginData):
-        while True:
-            try:
-                self.getRelevantMenu(loginData)
-            except IllegalChoice:
-                print("Illegal choice.")
-
-    def run(self, loginData):
-        while True:
-            self.getMenuForPlayer(loginData)
-
-
-def main():
-    game = Game()
-    print("Hello! What would you like to do?")
-    print("1. Login")
-    print("2. Register")
-    while True:
-        choice = input()
-        if not ((choice.isnumeric()) and (0 < int(choice) < 3)):
-            print("Illegal choice.")
-        else:
-            break
-
-    if choice == "1":
-        while True:
-            print("Enter username:")
-            username = input()
-            print("Enter password:")
-            password = getpass.getpass()
-            try:
-                game.login({"username": username, "password": password})
-                break
-            except LoginError as e:
-                print(e.reason)
-    else:
-        username, password = game.buildPlayer()
-
-    game.run({"username": username, "password": password})
-
-
-if __name__ == "__main__":
-    sys.exit(main())
+#
+# API 1st
+# > Think about Edge cases
+# > Make sure it's a PARAMETER
+#
+
+import json
+import math
+import os
+import sys
+import requests
+import getpass
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Game Class + Game Exceptions --> world.py
+
+# Player --> player.py
+
+# client.py <-- Init Player, World, Run.
+
+# GitLab <--
+
+serverAddress = "http://127.0.0.1:8081"
+# the form for new players rarely changes, so it's kept here and revalidated with its ETag
+formCachePath = os.path.join(os.path.expanduser("~"), ".game_form_cache.json")
+
+# transport settings: (connect, read) timeouts in seconds, and how many times a request is retried
+# when the server can't be reached (with exponential backoff starting at retryBackoff seconds).
+requestTimeout = (3.05, 10)
+maxRetries = 3
+retryBackoff = 0.2
+connectionPoolSize = 10
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+class GameException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return f"In Game Exception: {self.reason}"
+
+
+class IllegalChoice(GameException):
+    pass
+
+
+class IllegalInput(GameException):
+    pass
+
+
+class NoSuchPlayer(GameException):
+    pass
+
+
+class LoginError(GameException):
+    pass
+
+
+class ServerError(GameException):
+    pass
+
+
+def isInteger(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def isNumber(value):
+    try:
+        return math.isfinite(float(value))
+    except ValueError:
+        return False
+
+
+# the validation rules of the form for new players that can be checked here, by rule name
+RULE_CHECKS = {
+    "alpha": lambda value, rule: value.isalpha(),
+    "alphanumeric": lambda value, rule: value.isalnum(),
+    "integer": lambda value, rule: isInteger(value),
+    "number": lambda value, rule: isNumber(value),
+    "min": lambda value, rule: int(value) >= rule["value"],
+    "minLength": lambda value, rule: len(value) >= rule["value"]
+}
+
+
+def encodeRequest(body, useMsgpack):
+    # the headers and data of a request in the wire format, JSON unless useMsgpack is set
+    if useMsgpack:
+        return {'Accept': MSGPACK_MIMETYPE, 'Content-Type': MSGPACK_MIMETYPE}, msgpack.packb(body)
+    return {'Accept': 'application/json', 'Content-Type': 'application/json'}, json.dumps(body).encode('utf8')
+
+
+def decodeResponse(contentType, content):
+    # servers that don't support MessagePack answer in JSON, whatever was asked for
+    if contentType is not None and contentType.startswith(MSGPACK_MIMETYPE):
+        return msgpack.unpackb(content, timestamp=3)
+    return json.loads(content)
+
+
+def createHttpSession():
+    # a pooled session, so requests reuse kept-alive connections instead of opening a new one each time.
+    # only connection failures (and 502-504 on GET) are retried, actions that reached the server aren't re-sent.
+    retry = Retry(total=maxRetries, connect=maxRetries, read=0, status=maxRetries,
+                  status_forcelist=(502, 503, 504), backoff_factor=retryBackoff, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=connectionPoolSize, pool_maxsize=connectionPoolSize, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Game:
+    def sendToServer(self, path, body):
+        headers, data = encodeRequest(body, self.useMsgpack)
+        response = self.httpSession.post(url=(serverAddress + path), headers=headers, data=data,
+                                         timeout=requestTimeout)
+        return decodeResponse(response.headers.get('Content-Type'), response.content)
+
+    def sendPostRequestToServer(self, wantedAction, body):
+        return self.sendToServer("/invokeAction/" + wantedAction, body)
+
+    def sendBatchRequestToServer(self, entries):
+        # entries are {"action", "body"} dicts, the answers come back in the same order
+        return self.sendToServer("/invokeBatch", entries)
+
+    def getAuthenticatedBody(self, loginData, body):
+        # authenticating with the session token (if there is one), the login data is sent as the body itself
+        # or as body["loginData"] when the action has a body of its own.
+        if self.sessionToken is not None:
+            authData = {"sessionToken": self.sessionToken}
+        else:
+            authData = loginData
+        if body is None:
+            return authData
+        return dict(body, loginData=authData)
+
+    def isSessionExpired(self, answer):
+        return answer.get("message") == "SESSION EXPIRED" and self.sessionToken is not None
+
+    def sendAuthenticatedRequest(self, wantedAction, loginData, body=None):
+        while True:
+            answer = self.sendPostRequestToServer(wantedAction, self.getAuthenticatedBody(loginData, body))
+            if self.isSessionExpired(answer):
+                self.sessionToken = None
+                self.login(loginData)
+                continue
+            return answer
+
+    def sendAuthenticatedBatch(self, loginData, actions):
+        # actions are (action, body) pairs, each is authenticated like in sendAuthenticatedRequest.
+        # only the entries that found the session expired are sent again, the others were done
+        answers = [None] * len(actions)
+        pending = list(range(len(actions)))
+        while pending:
+            pendingAnswers = self.sendBatchRequestToServer([
+                {"action": actions[i][0], "body": self.getAuthenticatedBody(loginData, actions[i][1])}
+                for i in pending
+            ])
+            expired = []
+            for i, answer in zip(pending, pendingAnswers):
+                answers[i] = answer
+                if self.isSessionExpired(answer):
+                    expired.append(i)
+            if expired:
+                self.sessionToken = None
+                self.login(loginData)
+            pending = expired
+        return answers
+
+    def __init__(self, httpSession=None, useMsgpack=False):
+        # Games can share an http session (and its connection pool).
+        # with useMsgpack, requests and responses are MessagePack instead of JSON (which is cheaper to parse)
+        if useMsgpack and msgpack is None:
+            raise ImportError("useMsgpack needs the msgpack package")
+        self.httpSession = httpSession if httpSession is not None else createHttpSession()
+        self.useMsgpack = useMsgpack
+        self.sessionToken = None
+        # the menu that came back with the last choice, so it isn't requested again
+        self.nextMenu = None
+        # a local copy of the player, kept up to date with the changes handleChoice returns
+        self.playerState = None
+        self.playerVersion = None
+
+    def login(self, loginData):
+        details = self.sendPostRequestToServer("login", loginData)
+
+        if details["status"] == "FAILURE":
+            raise LoginError(details["message"])
+
+        self.sessionToken = details.get("sessionToken")
+        return details
+
+    def reformatTime(self, hour):
+        return str(hour).zfill(2) + ":00"
+
+    def getRelevantMenu(self, loginData):
+
+        if self.nextMenu is not None:
+            answer, self.nextMenu = self.nextMenu, None
+        else:
+            answer = self.sendAuthenticatedRequest("getRelevantMenu", loginData)
+        menu = answer["options"]
+        name = answer["name"]
+        time = answer["time"]
+        print(f"Hello {name}, it's {time} o'clock. what would you like to do?")
+        for i in range(len(menu)):
+            print(f"{str(i + 1)}. {menu[i]['string']}")
+        print("To show player details enter *")
+
+        choice = input()
+        if self.isValidMenuChoice(choice, menu):
+            if choice == '*':
+                if self.playerState is None:
+                    self.resyncPlayerState(loginData)
+                print(json.dumps(self.playerState, indent=4, sort_keys=False, default=str))
+            else:
+                # getting the next menu in the same round trip
+                answer, self.nextMenu = self.sendAuthenticatedBatch(loginData, [
+                    ("handleChoice", {"choice": menu[int(choice) - 1]["literal"],
+                                      "delta": True, "baseVersion": self.playerVersion}),
+                    ("getRelevantMenu", None)
+                ])
+                self.applyPlayerChanges(answer, loginData)
+        else:
+            raise IllegalChoice("Illegal choice")
+
+    def applyPlayerChanges(self, answer, loginData):
+        if answer["status"] == "FAILURE":
+            return
+        if "playerData" in answer:
+            # our copy was out of date, the server sent the whole player instead
+            self.playerState = answer["playerData"]
+        elif answer["baseVersion"] == self.playerVersion and self.playerState is not None:
+            changes = dict(answer["changes"])
+            skills = changes.pop("skills", None)
+            self.playerState.update(changes)
+            if skills is not None:
+                self.playerState["skills"].update(skills)
+        else:
+            self.resyncPlayerState(loginData)
+            return
+        self.playerVersion = answer["version"]
+
+    def resyncPlayerState(self, loginData):
+        details = self.sendAuthenticatedRequest("getPlayerByLoginData", loginData)
+        if details.get("status") == "FAILURE":
+            raise ServerError(details["message"])
+        details.pop("password", None)
+        self.playerState = details
+        self.playerVersion = details.get("version", 0)
+
+    def isValidMenuChoice(self, choice, options):
+        if (choice == '*') | (choice == '#'):
+            return True
+        elif choice.isnumeric() and int(choice) <= len(options):
+            return True
+        return False
+
+    def loadCachedForm(self):
+        try:
+            with open(formCachePath) as cacheFile:
+                return json.load(cacheFile)
+        except (OSError, ValueError):
+            return None
+
+    def saveCachedForm(self, etag, questions):
+        try:
+            with open(formCachePath, "w") as cacheFile:
+                json.dump({"etag": etag, "questions": questions}, cacheFile)
+        except OSError:
+            pass
+
+    def getQuestionsFromServer(self):
+        cachedForm = self.loadCachedForm()
+        headers = {}
+        if cachedForm is not None:
+            headers["If-None-Match"] = f'"{cachedForm["etag"]}"'
+
+        response = self.httpSession.get(url=(serverAddress + "/invokeAction/getFormForNewPlayer"),
+                                        headers=headers, timeout=requestTimeout)
+        if response.status_code == 304:
+            return cachedForm["questions"]
+
+        questions = response.json()
+        etag = response.headers.get("ETag")
+        if etag is not None:
+            self.saveCachedForm(etag.strip('"'), questions)
+        return questions
+
+    def handleCreatedPlayer(self, response, playerData):
+        if response["status"] == "FAILURE":
+            raise ServerError("An unknown error has occurred")
+        self.sessionToken = response.get("sessionToken")
+        return playerData["username"], playerData["password"]
+
+    def checkAnswer(self, givenInput, question):
+        # returns the message of the first validation rule the answer breaks, or None if it's valid.
+        # rules that only the server can check (or that we don't know) are checked with validateSingleInput.
+        rules = question.get("validation")
+        needsServer = rules is None
+        for rule in rules or ():
+            check = RULE_CHECKS.get(rule["rule"])
+            if rule.get("server") or check is None:
+                needsServer = True
+            elif not check(givenInput, rule):
+                return rule["message"]
+
+        if needsServer:
+            answer = self.sendPostRequestToServer("validateSingleInput", {
+                "givenInput": givenInput,
+                "type": question["type"],
+            })
+            if answer["status"] == "FAILURE":
+                return answer["message"]
+        return None
+
+    def askQuestion(self, question):
+        if question["type"] != "PASSWORD":
+            return input(question["question"] + "\n")
+        while True:
+            print(question["question"])
+            password = getpass.getpass()
+            print("Re-enter password:")
+            reEnterPassword = getpass.getpass()
+            if password != reEnterPassword:
+                print("Passwords don't match!")
+            else:
+                return password
+
+    def buildPlayer(self):
+        # Initialize as None for checking
+        player = {}
+        questions = self.getQuestionsFromServer()
+
+        while True:
+            for question in questions:
+                key = question["name"]
+                while player.get(key, None) is None:
+                    givenInput = self.askQuestion(question)
+                    message = self.checkAnswer(givenInput, question)
+                    if message is not None:
+                        print(message)
+                    else:
+                        player[key] = givenInput
+
+            # the server checks the answers again, e.g. the username might have been taken in the meantime
+            response = self.sendPostRequestToServer("createNewPlayer", player)
+            if response["status"] == "FAILURE" and response.get("question") is not None:
+                print(response["message"])
+                player[response["question"]] = None
+                continue
+            return self.handleCreatedPlayer(response, player)
+
+    def getMenuForPlayer(self, loginData):
+        while True:
+            try:
+                self.getRelevantMenu(loginData)
+            except IllegalChoice:
+                print("Illegal choice.")
+
+    def run(self, loginData):
+        while True:
+            self.getMenuForPlayer(loginData)
+
+
+def main():
+    game = Game()
+    print("Hello! What would you like to do?")
+    print("1. Login")
+    print("2. Register")
+    while True:
+        choice = input()
+        if not ((choice.isnumeric()) and (0 < int(choice) < 3)):
+            print("Illegal choice.")
+        else:
+            break
+
+    if choice == "1":
+        while True:
+            print("Enter username:")
+            username = input()
+            print("Enter password:")
+            password = getpass.getpass()
+            try:
+                game.login({"username": username, "password": password})
+                break
+            except LoginError as e:
+                print(e.reason)
+    else:
+        username, password = game.buildPlayer()
+
+    game.run({"username": username, "password": password})
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#
+# Headless load generator: simulates concurrent players that register (or log in) and then loop
+# getRelevantMenu -> handleChoice, and reports throughput and latency percentiles per action.
+#
+# By default it runs the Flask app in this process with an in-memory players collection,
+# so a run doesn't need Mongo or anything else:
+#   python loadgen.py --players 50 --duration 30 --think-time 0.05 --mix SLEEP=1,READ_A_BOOK=3
+# or against a running server:
+#   python loadgen.py --server http://127.0.0.1:8081 --players 50
+#
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import client
+import async_client
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # action -> seconds
+        self.errors = defaultdict(int)
+
+    async def measure(self, action, request):
+        start = time.perf_counter()
+        try:
+            answer = await request
+        except client.LoginError:
+            # a rejected login is a valid answer (e.g. the player isn't registered yet)
+            self.latencies[action].append(time.perf_counter() - start)
+            raise
+        except Exception:
+            self.errors[action] += 1
+            raise
+        self.latencies[action].append(time.perf_counter() - start)
+        answers = answer if isinstance(answer, list) else [answer]
+        if any(a.get("status") == "FAILURE" for a in answers):
+            self.errors[action] += 1
+        return answer
+
+    def report(self, duration):
+        print(f"{'action':>22} {'count':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for action in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[action])
+            print(f"{action:>22} {len(latencies):>8} {self.errors[action]:>7} {len(latencies) / duration:>9.1f} "
+                  f"{percentile(latencies, 50):>8.2f} {percentile(latencies, 95):>8.2f} "
+                  f"{percentile(latencies, 99):>8.2f}")
+
+
+def percentile(sortedValues, p):
+    # nearest-rank percentile, in milliseconds
+    if not sortedValues:
+        return 0.0
+    rank = max(0, int(round(p / 100 * len(sortedValues))) - 1)
+    return sortedValues[min(rank, len(sortedValues) - 1)] * 1000
+
+
+def parseMix(mix):
+    # "SLEEP=1,READ_A_BOOK=3" -> {"SLEEP": 1.0, "READ_A_BOOK": 3.0}, choices that aren't listed get a weight of 1
+    # (a copy of server/simulation.py's parseMix, kept in sync with it: the client doesn't import the server)
+    weights = {}
+    for entry in filter(None, mix.split(",")):
+        literal, weight = entry.split("=")
+        weights[literal.strip()] = float(weight)
+    return weights
+
+
+def randomName(rng, length=8):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length)).capitalize()
+
+
+async def simulatePlayer(index, httpSession, recorder, args, deadline):
+    rng = random.Random(args.seed + index)
+    game = async_client.AsyncGame(httpSession, useMsgpack=args.msgpack)
+    loginData = {"username": f"{args.prefix}{index}", "password": "botpassword"}
+
+    try:
+        await recorder.measure("login", game.login(loginData))
+    except client.LoginError:
+        await recorder.measure("createNewPlayer", game.createPlayer(dict(
+            loginData,
+            name=randomName(rng),
+            age=str(rng.randint(1, 40)),
+            height=str(rng.randint(50, 200)),
+            city=randomName(rng),
+            job=randomName(rng)
+        )))
+
+    iterations = 0
+    while time.monotonic() < deadline and (args.iterations is None or iterations < args.iterations):
+        menu = await recorder.measure("getRelevantMenu", game.getRelevantMenu(loginData))
+        options = [option["literal"] for option in menu.get("options", [])]
+        if not options:
+            break
+        choice = rng.choices(options, weights=[args.mix.get(option, 1.0) for option in options])[0]
+        await recorder.measure("handleChoice", game.sendAuthenticatedRequest("handleChoice", loginData,
+                                                                             {"choice": choice}))
+        iterations += 1
+        if args.think_time > 0:
+            await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+
+async def run(args):
+    recorder = LatencyRecorder()
+    client.connectionPoolSize = args.players
+    async with async_client.createHttpSession() as httpSession:
+        start = time.monotonic()
+        deadline = start + args.duration
+        results = await asyncio.gather(*[simulatePlayer(i, httpSession, recorder, args, deadline)
+                                         for i in range(args.players)], return_exceptions=True)
+        duration = time.monotonic() - start
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        print(f"{len(failed)} players stopped on an error, e.g.: {failed[0]!r}")
+    print(f"{args.players} players, {duration:.1f} seconds")
+    recorder.report(duration)
+
+
+def startLocalServer():
+    # the server module picks its storage when it's imported
+    os.environ["GAME_STORAGE"] = "memory"
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+    import server
+    from werkzeug.serving import make_server
+
+    server.logger.setLevel("WARNING")
+    logging.getLogger("werkzeug").setLevel("WARNING")
+    httpServer = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=httpServer.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpServer.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates concurrent players against the game server")
+    parser.add_argument("--players", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--iterations", type=int, default=None, help="menu/choice loops per player")
+    parser.add_argument("--think-time", type=float, default=0, help="mean seconds between actions")
+    parser.add_argument("--mix", type=parseMix, default={}, help="choice weights, e.g. SLEEP=1,READ_A_BOOK=3")
+    parser.add_argument("--server", default=None, help="server address, runs a local in-memory server if not given")
+    parser.add_argument("--prefix", default="bot", help="username prefix of the simulated players")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--msgpack", action="store_true", help="talk to the server in MessagePack instead of JSON")
+    args = parser.parse_args()
+
+    client.serverAddress = args.server if args.server is not None else startLocalServer()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
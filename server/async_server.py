@@ -0,0 +1,205 @@
+#
+# Asyncio serving mode: the same /invokeAction/<action> and /invokeBatch contract as server.py,
+# served by aiohttp with the players collection behind motor, so DB round trips don't hold a worker.
+#
+# Game actions run on the event loop (they only touch the players in memory), and the DB writes they make
+# are started on motor and awaited before the response is sent. Actions that might run the password KDF
+# (which takes a while on purpose) run on a thread, so they don't hold up the loop. Players are loaded on startup,
+# so LAZY_PLAYERS (which reads from the DB in the middle of an action) isn't supported in this mode,
+# and neither is ATOMIC_UPDATES (whose actions read the players they update from the DB).
+#
+#   python async_server.py
+#
+
+import asyncio
+import contextvars
+import sys
+import threading
+
+from aiohttp import web
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+
+# the DB writes started by the action (or batch) that's currently running
+pendingWrites = contextvars.ContextVar("pendingWrites", default=None)
+
+
+class PendingWrites:
+    """
+    The DB writes of a request. Each of them starts once the one before it is done, so they're applied
+    in the order the actions made them (e.g. a new player is inserted before a later entry of the batch updates it),
+    like they would be by the synchronous server.
+    """
+    def __init__(self):
+        self.writes = []
+
+    def start(self, write):
+        # write is a coroutine function, called on the event loop
+        previous = self.writes[-1] if self.writes else None
+
+        async def chained():
+            if previous is not None:
+                # its error (if any) is reported when the writes are gathered
+                await asyncio.wait([previous])
+            return await write()
+        future = asyncio.ensure_future(chained())
+        self.writes.append(future)
+        return future
+
+
+class DeferredCollection:
+    """
+    Wraps a motor collection for the synchronous Game code: writes are started right away (after the earlier
+    writes of the request) and collected in pendingWrites, to be awaited by the dispatcher once the action returns.
+    """
+    def __init__(self, collection, loop):
+        self.collection = collection
+        self.loop = loop
+        self.loopThread = threading.get_ident()
+
+    def _write(self, method, *args, **kwargs):
+        writes = pendingWrites.get()
+        if threading.get_ident() != self.loopThread:
+            if writes is not None:
+                # an action running on a thread (see mayHashPassword), its writes are started on the loop in order.
+                # it doesn't wait for them, it might be holding a player lock that an action on the loop is waiting for
+                self.loop.call_soon_threadsafe(writes.start, lambda: getattr(self.collection, method)(*args, **kwargs))
+                return None
+
+            # e.g. the write-behind flusher, which can just wait for the write
+            async def write():
+                return await getattr(self.collection, method)(*args, **kwargs)
+            return asyncio.run_coroutine_threadsafe(write(), self.loop).result()
+
+        if writes is None:
+            return asyncio.ensure_future(getattr(self.collection, method)(*args, **kwargs))
+        return writes.start(lambda: getattr(self.collection, method)(*args, **kwargs))
+
+    def insert_one(self, *args, **kwargs):
+        return self._write("insert_one", *args, **kwargs)
+
+    def update_one(self, *args, **kwargs):
+        return self._write("update_one", *args, **kwargs)
+
+    def bulk_write(self, *args, **kwargs):
+        return self._write("bulk_write", *args, **kwargs)
+
+    def __getattr__(self, name):
+        raise AttributeError(f"{name} isn't available on the players collection in the asyncio serving mode")
+
+
+def mayHashPassword(action, content=None):
+    # whether the action might run the password KDF: new players' passwords are hashed,
+    # and logins with a password are verified with it (unless they're in the credential cache).
+    # login (and getRelevantMenu/getPlayerByLoginData) take the login data as the body itself
+    if action in ("createNewPlayer", "login"):
+        return True
+    if not isinstance(content, dict):
+        return False
+    loginData = content.get("loginData")
+    return "password" in content or (isinstance(loginData, dict) and "password" in loginData)
+
+
+async def invokeAsync(function, *args, onThread=False):
+    # runs a dispatcher function of server.py (on a thread if onThread) and waits for the DB writes it started
+    writes = PendingWrites()
+    token = pendingWrites.set(writes)
+    try:
+        if onThread:
+            # the thread gets a copy of the context, with pendingWrites and the response format
+            body = await asyncio.to_thread(function, *args)
+        else:
+            body = function(*args)
+    finally:
+        pendingWrites.reset(token)
+    if writes.writes:
+        try:
+            await asyncio.gather(*writes.writes)
+        except Exception as e:
+            server.logger.exception(e)
+            return server.encodeResponse({"status": "FAILURE", "message": "AN INTERNAL ERROR HAS OCCURRED"})
+    return body
+
+
+def gameResponse(body, format):
+    return web.Response(body=body.encode('utf8') if isinstance(body, str) else body, content_type=format)
+
+
+async def readBody(request):
+    # JSON, or MessagePack if the Content-Type says so
+    return server.decodeRequest(await request.read(), request.content_type)
+
+
+async def invoke_action(request):
+    action = request.match_info["action"]
+    format = server.getResponseFormat(request.headers.get('Accept'))
+    with server.respondingIn(format):
+        if request.method == 'POST':
+            content = await readBody(request)
+            if content is None:
+                return gameResponse(server.encodeResponse({"status": "FAILURE", "message": "INVALID FORMAT"}),
+                                    format)
+
+        cachedResponse = server.game._getCachedResponse(action)
+        if request.method == 'GET' and cachedResponse is not None:
+            etag = f'"{cachedResponse.etag}"'
+            ifNoneMatch = request.headers.get('If-None-Match', '')
+            if etag in ifNoneMatch or ifNoneMatch.strip() == '*':
+                return web.Response(status=304, headers={'ETag': etag, 'Vary': 'Accept'})
+            return web.Response(body=cachedResponse.body, content_type=format,
+                                headers={'ETag': etag, 'Vary': 'Accept'})
+
+        if server.shouldProfile(request.headers.get(server.PROFILE_HEADER)):
+            invoke = server.profileGameAction
+        else:
+            invoke = server.invokeGameAction
+        if request.method == 'POST':
+            body = await invokeAsync(invoke, action, content, onThread=mayHashPassword(action, content))
+        else:  # GET
+            body = await invokeAsync(invoke, action, onThread=mayHashPassword(action))
+    return gameResponse(body, format)
+
+
+async def invoke_batch(request):
+    format = server.getResponseFormat(request.headers.get('Accept'))
+    with server.respondingIn(format):
+        entries = await readBody(request)
+        onThread = isinstance(entries, list) and any(
+            isinstance(entry, dict) and mayHashPassword(entry.get("action"), entry.get("body")) for entry in entries)
+        body = await invokeAsync(server.invokeGameBatch, entries, onThread=onThread)
+    return gameResponse(body, format)
+
+
+async def get_metrics(request):
+    return web.Response(text=server.metricsRegistry.render(), content_type='text/plain')
+
+
+async def connectToDB(app):
+    if server.LAZY_PLAYERS:
+        raise RuntimeError("LAZY_PLAYERS isn't supported in the asyncio serving mode")
+    if server.ATOMIC_UPDATES:
+        raise RuntimeError("ATOMIC_UPDATES isn't supported in the asyncio serving mode")
+    if server.STORAGE == "mongo":
+        collection = AsyncIOMotorClient('mongodb://localhost:27017/').Game.Player
+        # the timings of writes are of starting them, they're awaited after the action
+        server.PlayersCollection = server.InstrumentedCollection(
+            DeferredCollection(collection, asyncio.get_running_loop()))
+
+
+def createApp():
+    app = web.Application()
+    app.on_startup.append(connectToDB)
+    app.router.add_route('GET', '/invokeAction/{action}', invoke_action)
+    app.router.add_route('POST', '/invokeAction/{action}', invoke_action)
+    app.router.add_route('POST', '/invokeBatch', invoke_batch)
+    app.router.add_route('GET', '/metrics', get_metrics)
+    return app
+
+
+def main():
+    web.run_app(createApp(), host='localhost', port=8081)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#
+# Micro-benchmark of response serialization, the old _fixDictValues + json.dumps(default=str) path
+# against encodeJson (and MessagePack, if it's installed), on typical Player.data payloads.
+#
+# usage: python bench_json.py [number of runs]
+#
+
+import copy
+import json
+import os
+import sys
+import timeit
+from enum import Enum
+
+# only the server's classes are measured, against the in-memory collection
+os.environ.setdefault("GAME_STORAGE", "memory")
+import server  # noqa: E402
+
+
+def legacyFixDictValues(dictToFix):
+    for key in dictToFix:
+        if (type(key) is dict or
+                type(key) is list):
+            legacyFixDictValues(key)
+        elif (type(dictToFix[key]) is dict or
+              type(dictToFix[key]) is list):
+            dictToFix[key] = legacyFixDictValues(dictToFix[key])
+        elif isinstance(dictToFix[key], Enum):
+            dictToFix[key] = dictToFix[key].name
+
+    return dictToFix
+
+
+def legacyReformatJson(dictToFix):
+    return json.dumps(legacyFixDictValues(dictToFix), sort_keys=False, default=str)
+
+
+def buildPlayer():
+    player = server.Player({
+        "username": "benchmark",
+        "password": "0" * 32,
+        "name": "Bench",
+        "age": 30,
+        "height": 180,
+        "city": "Haifa",
+        "job": "Tester"
+    }, True)
+    return player
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    player = buildPlayer()
+    # (legacy payload, payload) pairs, the legacy path worked on plain dicts
+    payloads = {
+        "playerData": (player.data.toDict(), player.data),
+        "handleChoice": ({"status": "SUCCESS", "playerData": player.data.toDict()},
+                         {"status": "SUCCESS", "playerData": player.data}),
+        "form": (server.QuestionsForNewPlayer.getAllValues(), server.QuestionsForNewPlayer.getAllValues())
+    }
+
+    print(f"backend: {'orjson' if server.orjson is not None else 'json'}, {runs} runs each")
+    for name, (legacyPayload, payload) in payloads.items():
+        # the legacy path mutates its input, so it gets a fresh copy every time (the copy isn't timed)
+        copies = [copy.deepcopy(legacyPayload) for _ in range(runs)]
+        legacyTime = timeit.timeit(lambda: legacyReformatJson(copies.pop()), number=runs)
+        newTime = timeit.timeit(lambda: server.encodeJson(payload), number=runs)
+        line = (f"{name:>14}: legacy {legacyTime * 1e6 / runs:8.2f} us, "
+                f"encodeJson {newTime * 1e6 / runs:8.2f} us ({legacyTime / newTime:.2f}x)")
+        if server.msgpack is not None:
+            with server.respondingIn(server.MSGPACK_MIMETYPE):
+                msgpackTime = timeit.timeit(lambda: server.encodeResponse(payload), number=runs)
+            line += f", msgpack {msgpackTime * 1e6 / runs:8.2f} us"
+        print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#
+# Memory benchmark of resident players: the old dict based Player/Skills classes against
+# the slotted Player/PlayerData and array backed Skills.
+#
+# usage: python bench_memory.py [number of players]
+#
+
+import datetime
+import os
+import sys
+import tracemalloc
+import uuid
+
+# only the server's classes are measured, against the in-memory collection
+os.environ.setdefault("GAME_STORAGE", "memory")
+import server  # noqa: E402
+
+
+class LegacySkills(dict):
+    def __init__(self):
+        self['study_level'] = 0
+        self['music_level'] = 0
+        self['sports_level'] = 0
+        self['cooking_level'] = 0
+        self['social_level'] = 0
+        self['went_to_school'] = 0
+        self['went_to_sleep'] = 0
+
+
+class LegacyPlayer(dict):
+    def __init__(self, player_data):
+        self.data = player_data
+        self.pendingSet = {}
+        self.pendingInc = {}
+        self.deferredWrites = 0
+        self.data['_id'] = str(uuid.uuid4())
+        self.data['time_of_the_day'] = 8
+        self.data['skills'] = LegacySkills()
+        self.data['creation_time'] = datetime.datetime.utcnow()
+        self.data['last_update_time'] = datetime.datetime.utcnow()
+
+
+def answers(i):
+    return {
+        "username": f"player{i}",
+        "password": "0" * 32,
+        "name": "Bench",
+        "age": 30,
+        "height": 180,
+        "city": "Haifa",
+        "job": "Tester"
+    }
+
+
+def measure(createPlayer, count):
+    # bytes per player, not counting the answers the players are created from
+    allAnswers = [answers(i) for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    players = [createPlayer(playerAnswers) for playerAnswers in allAnswers]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del players
+    return (after - before) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # the legacy Player kept the answers dict itself, so it gets a copy to make the comparison fair
+    legacy = measure(lambda playerAnswers: LegacyPlayer(dict(playerAnswers)), count)
+    compact = measure(lambda playerAnswers: server.Player(playerAnswers, True), count)
+    print(f"{count} players: legacy {legacy:.0f} bytes/player, compact {compact:.0f} bytes/player "
+          f"({legacy / compact:.2f}x smaller)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
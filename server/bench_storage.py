@@ -0,0 +1,113 @@
+#
+# Compares the storage backends (see storage.py) under the handleChoice workload: every backend gets the same
+# population, and the same players make the same choices through Game.handleChoice.
+#
+#   python bench_storage.py --backends mongo,sqlite,memory --players 10000 --number 2000
+#   python bench_storage.py --backends sqlite --atomic    # with ATOMIC_UPDATES (find_one_and_update per change)
+#
+# Mongo is expected on --mongo-uri, the benchmark uses (and drops) a collection of its own there.
+#
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+# the server module picks its storage when it's imported, the backends are swapped in below
+os.environ["GAME_STORAGE"] = "memory"
+import server  # noqa: E402
+from memory_collection import MemoryCollection  # noqa: E402
+from sqlite_collection import SQLiteCollection  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+from pymongo.errors import PyMongoError  # noqa: E402
+
+
+def openBackend(name, args, directory):
+    # returns (collection, close), or None if the backend isn't available
+    if name == "memory":
+        return MemoryCollection(), lambda: None
+    if name == "sqlite":
+        return SQLiteCollection(os.path.join(directory, "players.db")), lambda: None
+    if name == "mongo":
+        client = MongoClient(args.mongo_uri, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("ping")
+        except PyMongoError as e:
+            print(f"mongo: not available ({e.__class__.__name__}), skipped", file=sys.stderr)
+            return None
+        collection = client.GameBenchmark.Player
+        collection.drop()
+        return collection, lambda: (collection.drop(), client.close())
+    raise ValueError(f"unknown backend: {name}")
+
+
+def populate(collection, size):
+    server.PlayersCollection = server.InstrumentedCollection(collection)
+    for i in range(size):
+        player = server.Player({
+            "username": f"player{i}",
+            "password": "",
+            "name": "Bench",
+            "age": 18 + i % 40,
+            "height": "180",
+            "city": "Haifa",
+            "job": "Tester"
+        }, True)
+        server.PlayersCollection.insert_one(player.data.toDict())
+    return server.Game()
+
+
+def benchmarkHandleChoice(game, active, number, repeat, seed):
+    # the players log in with sessions, so the password KDF isn't measured
+    rng = random.Random(seed)
+    playerIds = sorted(document["_id"] for document in server.PlayersCollection.find({}, {"_id": 1}))
+    sessions = [{"sessionToken": game.sessions.create(playerId)}
+                for playerId in rng.sample(playerIds, min(active, len(playerIds)))]
+
+    def handleChoice():
+        game.handleChoice({"loginData": rng.choice(sessions), "choice": rng.choice(server.ADULT_OPTIONS).name})
+
+    times = [t / number * 1e6 for t in timeit.repeat(handleChoice, number=number, repeat=repeat)]
+    return {"median_us": statistics.median(times), "min_us": min(times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the storage backends under the handleChoice workload")
+    parser.add_argument("--backends", default="mongo,sqlite,memory", help="comma separated: mongo, sqlite, memory")
+    parser.add_argument("--players", type=int, default=10000, help="the population size")
+    parser.add_argument("--active", type=int, default=1000, help="players that make choices")
+    parser.add_argument("--number", type=int, default=2000, help="choices per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per backend")
+    parser.add_argument("--atomic", action="store_true", help="run with ATOMIC_UPDATES")
+    parser.add_argument("--lazy", action="store_true", help="run with LAZY_PLAYERS")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server.logger.setLevel("WARNING")
+    server.ATOMIC_UPDATES = args.atomic
+    server.LAZY_PLAYERS = args.lazy
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.backends.split(","):
+            backend = openBackend(name, args, directory)
+            if backend is None:
+                continue
+            collection, close = backend
+            try:
+                game = populate(collection, args.players)
+                results[name] = benchmarkHandleChoice(game, args.active, args.number, args.repeat, args.seed)
+            finally:
+                close()
+            print(f"{name}: handleChoice {results[name]['median_us']:.2f}us", file=sys.stderr)
+
+    print(json.dumps(results, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
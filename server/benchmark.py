@@ -0,0 +1,126 @@
+#
+# Microbenchmarks of the server's request path, at several player population sizes,
+# against the in-memory players collection (GAME_STORAGE=memory).
+#
+#   python benchmark.py --sizes 1000,100000,1000000 --output results.json
+#   python benchmark.py --baseline results.json    # exits with 1 if a benchmark got slower than the tolerance
+#
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import timeit
+
+# the server module picks its storage when it's imported
+os.environ["GAME_STORAGE"] = "memory"
+import server  # noqa: E402
+
+PASSWORD = "benchmarkpassword"
+
+
+def populate(size):
+    server.PlayersCollection = server.InstrumentedCollection(server.MemoryCollection())
+    passwordHash = server.game._getHashValue(PASSWORD)
+    for i in range(size):
+        player = server.Player({
+            "username": f"player{i}",
+            "password": passwordHash,
+            "name": "Bench",
+            "age": str(18 + i % 40),
+            "height": "180",
+            "city": "Haifa",
+            "job": "Tester"
+        }, True)
+        server.PlayersCollection.insert_one(player.data.toDict())
+    return server.Game()
+
+
+def buildBenchmarks(game, size, active, rng):
+    # logins go to a set of active players, whose credentials were verified once already (like real traffic),
+    # so the benchmarks measure the request path rather than the password KDF.
+    activePlayers = rng.sample(range(size), min(active, size))
+    for i in activePlayers:
+        game._getPlayerByLoginData({"username": f"player{i}", "password": PASSWORD})
+
+    def randomLoginData():
+        return {"username": f"player{rng.choice(activePlayers)}", "password": PASSWORD}
+
+    newPlayer = {"username": "newplayer", "password": PASSWORD, "name": "Bench", "age": "30",
+                 "height": "180", "city": "Haifa", "job": "Tester"}
+
+    return {
+        "_getPlayerByLoginData": lambda: game._getPlayerByLoginData(randomLoginData()),
+        "_validatePlayer": lambda: game._validatePlayer(newPlayer),
+        "_reformatJson": lambda: game._reformatJson(game._getPlayerByLoginData(randomLoginData()).data),
+        "getRelevantMenu": lambda: game.getRelevantMenu(randomLoginData()),
+        "handleChoice": lambda: game.handleChoice({"loginData": randomLoginData(),
+                                                   "choice": rng.choice(server.ADULT_OPTIONS).name})
+    }
+
+
+def measure(function, number, repeat):
+    # per call times in microseconds
+    times = [t / number * 1e6 for t in timeit.repeat(function, number=number, repeat=repeat)]
+    return {"median_us": statistics.median(times), "min_us": min(times)}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            ratio = result["median_us"] / previous["median_us"]
+            marker = ""
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name}@{size}")
+                marker = "  <-- REGRESSION"
+            print(f"{size:>9} {name:>24}: {previous['median_us']:10.2f} -> {result['median_us']:10.2f} us "
+                  f"({ratio:.2f}x){marker}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the server's request path")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma separated player population sizes")
+    parser.add_argument("--number", type=int, default=1000, help="calls per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per benchmark")
+    parser.add_argument("--output", default=None, help="file to write the results to (JSON), stdout if not given")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument("--active", type=int, default=1000, help="players that log in during the benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server.logger.setLevel("WARNING")
+    results = {}
+    for size in map(int, args.sizes.split(",")):
+        game = populate(size)
+        rng = random.Random(args.seed)
+        results[str(size)] = {name: measure(function, args.number, args.repeat)
+                              for name, function in buildBenchmarks(game, size, args.active, rng).items()}
+        print(f"{size} players: " + ", ".join(f"{name} {result['median_us']:.2f}us"
+                                              for name, result in results[str(size)].items()), file=sys.stderr)
+
+    output = json.dumps(results, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output)
+    else:
+        print(output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            regressions = compare(results, json.load(baselineFile), args.tolerance)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#
+# Checks that concurrent actions of the same player are serialized (see LockStripes): many threads make choices
+# for one player, and every choice has to be counted exactly once, in memory and in the stored document.
+# The lazy mode also runs with fewer cache slots and lock stripes than players, so loads keep evicting
+# each other's players.
+#
+#   python check_concurrency.py                      # all the modes
+#   python check_concurrency.py --modes eager,atomic --threads 32 --choices 500
+#
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+# the checks run against the in-memory collection
+os.environ.setdefault("GAME_STORAGE", "memory")
+import server  # noqa: E402
+from server import ChoiceOptions  # noqa: E402
+from memory_collection import MemoryCollection  # noqa: E402
+from storage import getPath  # noqa: E402
+
+MODES = ("eager", "atomic", "writeBehind", "lazy")
+# adult choices don't trigger the linked events, so the expected state only depends on how many were made
+CHOICES = (ChoiceOptions.READ_A_BOOK, ChoiceOptions.MEET_FRIENDS, ChoiceOptions.PLAY_FOOTBALL)
+
+
+def setUp(mode, players):
+    server.PlayersCollection = server.InstrumentedCollection(MemoryCollection())
+    server.ATOMIC_UPDATES = mode == "atomic"
+    server.LAZY_PLAYERS = mode == "lazy"
+    server.PLAYER_CACHE_SIZE = 2
+    server.playerLocks = server.LockStripes(2 if mode == "lazy" else server.PLAYER_LOCK_STRIPES)
+    server.writeBehind = server.WriteBehindFlusher(0.01, 4) if mode == "writeBehind" else None
+
+    playerIds = []
+    for i in range(players):
+        player = server.Player({"username": f"player{i}", "password": "", "name": "Check", "age": 30}, True)
+        server.PlayersCollection.insert_one(player.data.toDict())
+        playerIds.append(player.data["_id"])
+    return server.Game(), playerIds
+
+
+def checkMode(mode, threads, choices, seed, timeout):
+    game, playerIds = setUp(mode, players=8 if mode == "lazy" else 1)
+    sessions = {playerId: {"sessionToken": game.sessions.create(playerId)} for playerId in playerIds}
+    made = {playerId: {choice: 0 for choice in CHOICES} for playerId in playerIds}
+    madeLock = threading.Lock()
+    errors = []
+
+    def hammer(threadSeed):
+        rng = random.Random(threadSeed)
+        try:
+            for _ in range(choices):
+                playerId = rng.choice(playerIds)
+                choice = rng.choice(CHOICES)
+                game.handleChoice({"loginData": sessions[playerId], "choice": choice.name})
+                with madeLock:
+                    made[playerId][choice] += 1
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=hammer, args=(seed + i,), daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    if any(worker.is_alive() for worker in workers):
+        return [f"threads still running after {timeout}s (deadlock?)"]
+    if errors:
+        return [f"{type(e).__name__}: {e}" for e in errors]
+    if server.writeBehind is not None:
+        server.writeBehind.stop()
+
+    failures = []
+    for playerId, counts in made.items():
+        total = sum(counts.values())
+        expected = {"version": total, "time_of_the_day": 8 + sum(choice.value["timeSpent"] * count
+                                                                 for choice, count in counts.items())}
+        expected.update({f"skills.{choice.value['skill']}": count for choice, count in counts.items()})
+        stored = server.PlayersCollection.find_one({"_id": playerId})
+        inMemory = game._getPlayerById(playerId).data.toDict()
+        for field, value in expected.items():
+            actual = (getPath(stored, field), getPath(inMemory, field))
+            if actual != (value, value):
+                failures.append(f"{playerId} {field}: expected {value}, stored/in memory {actual}")
+        if inMemory != stored:
+            failures.append(f"{playerId}: in memory {inMemory} != stored {stored}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammers players from many threads and checks no choice is lost")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: " + ", ".join(MODES))
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--choices", type=int, default=300, help="choices per thread")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the threads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server.logger.setLevel("WARNING")
+    failed = False
+    for mode in args.modes.split(","):
+        failures = checkMode(mode, args.threads, args.choices, args.seed, args.timeout)
+        if failures:
+            failed = True
+            print(f"{mode}: FAILED", file=sys.stderr)
+            for failure in failures[:10]:
+                print(f"    {failure}", file=sys.stderr)
+        else:
+            print(f"{mode}: OK, {args.threads} threads x {args.choices} choices")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#
+# An append-only journal of entries (dicts) in numbered segment files, with group commit: entries that are
+# appended while an fsync is running are written and fsynced together by the next one. Snapshots are written
+# next to the segments and name the first segment that isn't in them, older segments and snapshots are deleted.
+# A directory is used by one process at a time, it holds a lock on journal.lock while the journal is open.
+#
+#   journal.00000001.log, journal.00000002.log, ...    one JSON entry per line, each with its "seq" number
+#   snapshot.00000002.json                             a header line and then one record per line
+#
+
+import datetime
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where the directory isn't locked
+    fcntl = None
+
+
+def encodeValue(o):
+    if isinstance(o, datetime.datetime):
+        return {"$date": o.isoformat()}
+    raise TypeError(f"{type(o).__name__} can't be journaled")
+
+
+def decodeObject(o):
+    if len(o) == 1 and "$date" in o:
+        return datetime.datetime.fromisoformat(o["$date"])
+    return o
+
+
+def encodeLine(o):
+    return json.dumps(o, default=encodeValue, separators=(",", ":")).encode('utf8') + b"\n"
+
+
+def decodeLine(line):
+    return json.loads(line, object_hook=decodeObject)
+
+
+class Journal:
+    def __init__(self, directory, segmentSize, fsync=True):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.lockFile = self._lockDirectory()
+        self.seq = 0  # of the last appended entry
+        self.durableSeq = 0  # of the last entry that's written (and fsynced)
+        self.buffer = []
+        self.lock = threading.Lock()  # guards seq and buffer
+        self.commitLock = threading.Lock()  # held by the thread that's writing
+        self.file = None
+        self.segment = max(self._listFiles("journal", ".log") or [0])
+
+    def _lockDirectory(self):
+        # another process writing to the directory would overwrite the snapshots and delete the segments of this one
+        lockFile = open(os.path.join(self.directory, "journal.lock"), "a")
+        if fcntl is not None:
+            try:
+                # a POSIX lock, which (unlike flock) isn't inherited by forked processes like the hashing pool's
+                fcntl.lockf(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lockFile.close()
+                raise RuntimeError(f"the journal in {self.directory} is used by another process")
+        return lockFile
+
+    def _listFiles(self, prefix, suffix):
+        numbers = []
+        for name in os.listdir(self.directory):
+            number = name[len(prefix) + 1:-len(suffix)]
+            if name.startswith(prefix + ".") and name.endswith(suffix) and number.isdigit():
+                numbers.append(int(number))
+        return sorted(numbers)
+
+    def _path(self, prefix, number, suffix):
+        return os.path.join(self.directory, f"{prefix}.{number:08d}{suffix}")
+
+    def readSnapshot(self):
+        # (header, records) of the latest snapshot, or (None, []) if there isn't one
+        snapshots = self._listFiles("snapshot", ".json")
+        if not snapshots:
+            return None, []
+
+        def records(snapshotFile):
+            with snapshotFile:
+                for line in snapshotFile:
+                    yield decodeLine(line)
+        snapshotFile = open(self._path("snapshot", snapshots[-1], ".json"), "rb")
+        return decodeLine(snapshotFile.readline()), records(snapshotFile)
+
+    def readEntries(self, fromSegment):
+        # the entries of the segments from fromSegment on, the seq numbering continues after them.
+        # a segment ends at an entry that wasn't fully written (the last one before a crash),
+        # the run after it started a segment of its own.
+        for segment in self._listFiles("journal", ".log"):
+            if segment < fromSegment:
+                continue
+            with open(self._path("journal", segment, ".log"), "rb") as segmentFile:
+                for line in segmentFile:
+                    try:
+                        entry = decodeLine(line)
+                    except ValueError:
+                        break
+                    self.seq = self.durableSeq = max(self.seq, entry["seq"])
+                    yield entry
+
+    def append(self, entry):
+        # returns the entry's seq number once it's written
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self.buffer.append(encodeLine(dict(entry, seq=seq)))
+        self._commit(seq)
+        return seq
+
+    def _commit(self, seq):
+        with self.commitLock:
+            if self.durableSeq >= seq:
+                # written by another thread's commit
+                return
+            self._write()
+
+    def _write(self):
+        # called with commitLock held
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            seq = self.seq
+        if not lines:
+            return
+        if self.file is None or self.file.tell() >= self.segmentSize:
+            self._rotate()
+        self.file.write(b"".join(lines))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.durableSeq = seq
+
+    def _rotate(self):
+        # a new segment is started on every run, so nothing is appended after a torn entry
+        if self.file is not None:
+            self.file.close()
+        self.segment += 1
+        self.file = open(self._path("journal", self.segment, ".log"), "ab")
+
+    def writeSnapshot(self, getRecords):
+        # getRecords() gives the records to snapshot, it's called after the journal moved to a new segment,
+        # so the entries the records might not include are in that segment or after it
+        with self.commitLock:
+            self._write()
+            self._rotate()
+            header = {"segment": self.segment, "seq": self.durableSeq}
+
+        path = self._path("snapshot", header["segment"], ".json")
+        with open(path + ".tmp", "wb") as snapshotFile:
+            snapshotFile.write(encodeLine(header))
+            for record in getRecords():
+                snapshotFile.write(encodeLine(record))
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.replace(path + ".tmp", path)
+
+        for snapshot in self._listFiles("snapshot", ".json"):
+            if snapshot < header["segment"]:
+                os.remove(self._path("snapshot", snapshot, ".json"))
+        for segment in self._listFiles("journal", ".log"):
+            if segment < header["segment"]:
+                os.remove(self._path("journal", segment, ".log"))
+
+    def close(self):
+        with self.commitLock:
+            self._write()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.lockFile is not None:
+                self.lockFile.close()
+                self.lockFile = None
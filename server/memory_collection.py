@@ -0,0 +1,118 @@
+import copy
+import threading
+
+from storage import PlayersStorage, DuplicateKeyError, isCondition, matchesFilter, project, applyUpdate
+
+
+class MemoryCursor:
+    # the results of a find(), index hints and batch sizes are accepted and ignored
+    def __init__(self, documents):
+        self.documents = documents
+
+    def hint(self, index):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def sort(self, key, direction=1):
+        # sorts by a single top level field
+        self.documents.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        return self
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class MemoryCollection(PlayersStorage):
+    """
+    An in-process stand-in for the players collection, with the part of the pymongo Collection API the server uses.
+    Documents are copied in and out like they would be by a real DB, and fields that are indexed
+    with create_index can be queried without a scan.
+    """
+    def __init__(self):
+        self.documents = {}  # _id -> document
+        self.indexes = {}  # field -> {value: set of _ids}
+        self.lock = threading.RLock()
+
+    def create_index(self, keys, unique=False, **kwargs):
+        field = keys if isinstance(keys, str) else keys[0][0]
+        with self.lock:
+            # only top level fields are indexed, queries on nested fields scan
+            if field == "_id" or field in self.indexes or "." in field:
+                return field
+            index = {}
+            for document in self.documents.values():
+                index.setdefault(document.get(field), set()).add(document["_id"])
+            self.indexes[field] = index
+        return field
+
+    def insert_one(self, document):
+        with self.lock:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError(f"duplicate _id: {document['_id']}")
+            stored = copy.deepcopy(document)
+            self.documents[stored["_id"]] = stored
+            for field, index in self.indexes.items():
+                index.setdefault(stored.get(field), set()).add(stored["_id"])
+
+    def find(self, filter=None, projection=None):
+        with self.lock:
+            documents = [project(document, projection) for document in self._match(filter or {})]
+        return MemoryCursor(documents)
+
+    def find_one(self, filter=None, projection=None):
+        with self.lock:
+            for document in self._match(filter or {}):
+                return project(document, projection)
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        with self.lock:
+            return len(self._match(filter))
+
+    def update_one(self, filter, update):
+        with self.lock:
+            documents = self._match(filter)
+            if documents:
+                self._apply(documents[0], update)
+            return len(documents)
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=False):
+        if isinstance(update, list):
+            raise NotImplementedError("aggregation pipeline updates aren't supported")
+        with self.lock:
+            documents = self._match(filter)
+            if not documents:
+                return None
+            before = project(documents[0], projection)
+            self._apply(documents[0], update)
+            return project(documents[0], projection) if return_document else before
+
+    def bulk_write(self, requests, ordered=True):
+        with self.lock:
+            for request in requests:
+                self.update_one(request._filter, request._doc)
+
+    def _match(self, filter):
+        if "_id" in filter and not isCondition(filter["_id"]):
+            candidates = [self.documents[filter["_id"]]] if filter["_id"] in self.documents else []
+        elif "_id" in filter and "$in" in filter["_id"]:
+            candidates = [self.documents[_id] for _id in filter["_id"]["$in"] if _id in self.documents]
+        else:
+            candidates = None
+            for field, index in self.indexes.items():
+                if field in filter and not isCondition(filter[field]):
+                    candidates = [self.documents[_id] for _id in index.get(filter[field], ())]
+                    break
+            if candidates is None:
+                candidates = self.documents.values()
+        return [document for document in candidates if matchesFilter(document, filter)]
+
+    def _apply(self, document, update):
+        indexedValues = {field: document.get(field) for field in self.indexes}
+        applyUpdate(document, update)
+        for field, index in self.indexes.items():
+            if document.get(field) != indexedValues[field]:
+                index[indexedValues[field]].discard(document["_id"])
+                index.setdefault(document.get(field), set()).add(document["_id"])
@@ -0,0 +1,103 @@
+#
+# Counters and histograms with labels, rendered in the Prometheus text format (served on /metrics).
+# Updates take a lock and a couple of dict lookups, so they're cheap enough to leave on.
+#
+
+import bisect
+import threading
+
+# in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def formatLabels(labelNames, labelValues, extra=""):
+    labels = [f'{name}="{escapeLabelValue(value)}"' for name, value in zip(labelNames, labelValues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escapeLabelValue(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self.values = {}  # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, labelValues=(), by=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + by
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for labelValues, value in sorted(values.items()):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {formatValue(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, labelValues=()):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(labelValues)
+            if values is None:
+                values = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            values[0][bucket] += 1
+            values[1] += value
+            values[2] += 1
+
+    def render(self):
+        with self.lock:
+            values = {labelValues: (list(counts), total, count)
+                      for labelValues, (counts, total, count) in self.values.items()}
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labelValues, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucketCount
+                le = f'le="{formatValue(bound) if bound != "+Inf" else bound}"'
+                lines.append(f"{self.name}_bucket{formatLabels(self.labelNames, labelValues, le)} {cumulative}")
+            labels = formatLabels(self.labelNames, labelValues)
+            lines.append(f"{self.name}_sum{labels} {formatValue(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labelNames=()):
+        return self.register(Counter(name, description, labelNames))
+
+    def histogram(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labelNames, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
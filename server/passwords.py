@@ -0,0 +1,38 @@
+#
+# Password hashing. These run in the server's hashing process pool, so they're kept apart from server.py
+# (the pool's processes only need this module).
+#
+
+import hashlib
+import hmac
+import os
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 260000
+SALT_BYTES = 16
+
+
+def hashPassword(password, iterations=ITERATIONS):
+    # "<algorithm>$<iterations>$<salt>$<hash>"
+    salt = os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode('utf8'), salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verifyPassword(password, storedHash):
+    if isLegacyHash(storedHash):
+        return hmac.compare_digest(storedHash, legacyHash(password))
+    algorithm, iterations, salt, digest = storedHash.split("$")
+    if algorithm != ALGORITHM:
+        return False
+    computed = hashlib.pbkdf2_hmac("sha256", password.encode('utf8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(computed.hex(), digest)
+
+
+def legacyHash(password):
+    # unsalted MD5, which older versions stored
+    return hashlib.md5(password.encode('utf8')).hexdigest()
+
+
+def isLegacyHash(storedHash):
+    return "$" not in storedHash
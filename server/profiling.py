@@ -0,0 +1,73 @@
+#
+# Per-request profiling: actions run under cProfile and their stats are kept in a directory, the newest
+# `maxCaptures` of them, named "<action>.<time in ns>.prof" (they can be opened with pstats).
+#
+
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+SORT_KEYS = {"totalTime": 2, "cumulativeTime": 3}
+
+
+class ProfileStore:
+    def __init__(self, directory, maxCaptures):
+        self.directory = directory
+        self.maxCaptures = maxCaptures
+        # one action is profiled at a time (a profiler is per interpreter on newer Pythons)
+        self.lock = threading.Lock()
+
+    def run(self, action, function, *args):
+        # runs function(*args) under the profiler and saves the capture, or just runs it
+        # if another action is being profiled
+        if not self.lock.acquire(blocking=False):
+            return function(*args)
+        try:
+            profiler = cProfile.Profile()
+            result = profiler.runcall(function, *args)
+            self._save(action, profiler)
+            return result
+        finally:
+            self.lock.release()
+
+    def _save(self, action, profiler):
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.directory, f"{action}.{time.time_ns()}.prof"))
+        for capture in self.list()[:-self.maxCaptures]:
+            try:
+                os.remove(capture["path"])
+            except OSError:
+                pass
+
+    def list(self, action=None):
+        # the captures, oldest first
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        captures = []
+        for name in names:
+            parts = name.split(".")
+            if len(parts) != 3 or parts[2] != "prof" or not parts[1].isdigit():
+                continue
+            if action is None or parts[0] == action:
+                captures.append({"action": parts[0], "time": int(parts[1]) / 1e9,
+                                 "path": os.path.join(self.directory, name)})
+        return sorted(captures, key=lambda capture: capture["time"])
+
+    def getHotFunctions(self, captures, count, sortBy="totalTime"):
+        # the functions that took the most time over all the captures, by their own time (totalTime)
+        # or including the functions they called (cumulativeTime)
+        paths = [capture["path"] for capture in captures if os.path.exists(capture["path"])]
+        if not paths:
+            return []
+        stats = pstats.Stats(*paths)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][SORT_KEYS[sortBy]], reverse=True)
+        return [{
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "totalTime": totalTime,
+            "cumulativeTime": cumulativeTime
+        } for (filename, line, name), (_, calls, totalTime, cumulativeTime, _) in functions[:count]]
@@ -1,503 +1,1833 @@
-from random import random
-from flask import Flask, request, Response
-from enum import Enum
-import json
-import uuid
-import logging
-from pymongo import MongoClient
-import datetime
-import hashlib
-
-logger = logging.getLogger('root')
-FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
-logging.basicConfig(format=FORMAT)
-logger.setLevel(logging.DEBUG)
-
-db = MongoClient('mongodb://localhost:27017/').Game
-PlayersCollection = db.Player
-
-
-class GameException(Exception):
-    def __init__(self, reason):
-        self.reason = reason
-
-    def __str__(self):
-        return f"In Game Exception: {self.reason}"
-
-
-class IllegalChoice(GameException):
-    pass
-
-
-class FormException(GameException):
-    def __init__(self, reason, question):
-        self.reason = reason
-        self.question = question
-
-    pass
-
-
-class DoubleInput(FormException):
-    pass
-
-
-class MissingInput(FormException):
-    pass
-
-
-class IllegalInput(FormException):
-    pass
-
-
-class PlayerNotFound(GameException):
-    pass
-
-
-class EnumNotFound(GameException):
-    pass
-
-
-class LoginError(GameException):
-    pass
-
-
-class UsernameIsTaken(GameException):
-    pass
-
-
-class Skills(dict):
-    def __init__(self):
-        self['study_level'] = 0
-        self['music_level'] = 0
-        self['sports_level'] = 0
-        self['cooking_level'] = 0
-        self['social_level'] = 0
-        self['went_to_school'] = 0
-        self['went_to_sleep'] = 0
-
-
-class Player(dict):
-    def __init__(self, player_data, isNew):
-        self.data = player_data
-        if isNew:
-            self.data['_id'] = str(uuid.uuid4())
-            self.data['time_of_the_day'] = 8
-            self.data['skills'] = Skills()
-            self.data['creation_time'] = datetime.datetime.utcnow()
-            self.data['last_update_time'] = datetime.datetime.utcnow()
-
-    def get(self, attribute):
-        return self.data[attribute]
-
-    def set(self, attribute, value):
-        self.data[attribute] = value
-        self.updateInDB({attribute: value})
-
-    def getSkill(self, skill):
-        return self.data['skills'][skill]
-
-    def raiseSkill(self, skill, by):
-        skills = self.data['skills']
-        skills[skill] += by
-        self.updateInDB({"skills": skills})
-
-    def spendTime(self, by):
-        self.data['time_of_the_day'] += by
-        self.updateInDB({'time_of_the_day': self.data['time_of_the_day']})
-
-    def raiseAge(self, by):
-        self.data['age'] += by
-        self.updateInDB({'age': self.data['age']})
-
-    def updateInDB(self, delta):
-        delta['last_update_time'] = datetime.datetime.utcnow()
-        query = {"_id": self.data["_id"]}
-        newvalues = {"$set": delta}
-        PlayersCollection.update_one(query, newvalues)
-
-
-class InputType(Enum):
-    NAME = 1
-    UNSIGNED = 2
-    DOUBLE = 3
-    USERNAME = 4
-    PASSWORD = 5
-
-    def getByLiteral(self, literal):
-        return self[literal]
-
-
-class QuestionsForNewPlayer(Enum):
-    username = {
-        "question": "Choose username:",
-        "type": InputType.USERNAME,
-        "html_type": "text"
-    }
-    password = {
-        "question": "Choose password:",
-        "type": InputType.PASSWORD,
-        "html_type": "password"
-    }
-    name = {
-        "question": "What's your name?",
-        "type": InputType.NAME,
-        "html_type": "text"
-    }
-    age = {
-        "question": "What's your age?",
-        "type": InputType.UNSIGNED,
-        "html_type": "number"
-    }
-    height = {
-        "question": "What's your height (cm)?",
-        "type": InputType.UNSIGNED,
-        "html_type": "number"
-    }
-    city = {
-        "question": "Where do you live?",
-        "type": InputType.NAME,
-        "html_type": "text"
-    }
-    job = {
-        "question": "What is your profession?",
-        "type": InputType.NAME,
-        "html_type": "text"
-    }
-
-    @staticmethod
-    def getAllLiterals():
-        return list(map(lambda q: q.name, QuestionsForNewPlayer))
-
-    @staticmethod
-    def getAllValues():
-        questions = list(map(lambda q: q.value, QuestionsForNewPlayer))
-        questionNames = list(map(lambda q: q.name, QuestionsForNewPlayer))
-
-        # adding the literal names to the dictionaries:
-        for i in range(len(questions)):
-            questions[i]["name"] = questionNames[i]
-        return questions
-
-    def getByLiteral(self, literal):
-        wantedEnum = self[literal]
-        if wantedEnum is None:
-            raise EnumNotFound(f"NO SUCH ENUM: {literal}")
-        return wantedEnum
-
-
-class ChoiceOptions(Enum):
-    SLEEP = {
-        "string": "Sleep",
-        "skill": "went_to_sleep",
-        "timeSpent": 1
-    }
-    GO_TO_SCHOOL = {
-        "string": "Go to school",
-        "skill": "went_to_school",
-        "timeSpent": 8,
-    }
-    LEARN_COOKING = {
-        "string": "Learn cooking",
-        "skill": "cooking_level",
-        "timeSpent": 2
-    }
-    LEARN_GUITAR = {
-        "string": "Learn guitar",
-        "skill": "music_level",
-        "timeSpent": 2
-    }
-    PLAY_FOOTBALL = {
-        "string": "Play football",
-        "skill": "sports_level",
-        "timeSpent": 2
-    }
-    MEET_FRIENDS = {
-        "string": "Meet friends",
-        "skill": "social_level",
-        "timeSpent": 3
-    }
-    READ_A_BOOK = {
-        "string": "Read a book",
-        "skill": "study_level",
-        "timeSpent": 4
-    }
-
-    def getByLiteral(self, literal):
-        wantedEnum = self[literal]
-        if wantedEnum is None:
-            raise EnumNotFound(f"NO SUCH ENUM: {literal}")
-        return wantedEnum
-
-
-class Game:
-    def __init__(self):
-        self.players = []
-        playersData = PlayersCollection.find()
-        for playerData in playersData:
-            self.players.append(Player(playerData, False))
-
-    def _fixDictValues(self, dictToFix):
-        for key in dictToFix:
-            if (type(key) is dict or
-                    type(key) is list):
-                self._fixDictValues(key)
-            elif (type(dictToFix[key]) is dict or
-                  type(dictToFix[key]) is list):
-                dictToFix[key] = self._fixDictValues(dictToFix[key])
-            elif isinstance(dictToFix[key], Enum):
-                # Replacing enums with their literal
-                dictToFix[key] = dictToFix[key].name
-
-        return dictToFix
-
-    def _reformatJson(self, dictToFix):
-        dictToFix = self._fixDictValues(dictToFix)
-
-        return json.dumps(dictToFix, sort_keys=False, default=str)
-
-    def _getHashValue(self, string):
-        return hashlib.md5(string.encode('utf8')).hexdigest()
-
-    def _getPlayerById(self, id):
-        for player in self.players:
-            if player.data['_id'] == id:
-                return player
-        raise PlayerNotFound(f"NO PLAYER WITH ID: {id}")
-
-    def _getPlayerByLoginData(self, loginData):
-        for player in self.players:
-            if player.data["username"] == loginData["username"]:
-                if player.data["password"] == self._getHashValue(loginData["password"]):
-                    return player
-
-        raise LoginError("Incorrect username/password")
-
-    def _validateInput(self, input, inputType):
-        if inputType == InputType.NAME:
-            return self._validateName(input)
-        elif inputType == InputType.UNSIGNED:
-            return self._validateUnsign(input)
-        elif inputType == InputType.USERNAME:
-            return self._validateUsername(input)
-        elif inputType == InputType.PASSWORD:
-            return self._validatePassword(input)
-
-    def _validateUsername(self, username):
-        if not username.isalnum():
-            raise IllegalInput("Given input isn't alphanumeric.")
-        for player in self.players:
-            if player.data["username"] == username:
-                raise UsernameIsTaken(f"Username {username} is already taken")
-
-        return username
-
-    def _validatePassword(self, password):
-        if len(password) < 7:
-            raise IllegalInput("Password must contain at least 7 characters")
-
-        return password
-
-    def _validateUnsign(self, number):
-        try:
-            num = int(number)
-            if num > 0:
-                return num
-            else:
-                raise IllegalInput("Given input isn't positive.")
-
-        except ValueError:
-            raise IllegalInput("Given input isn't an integer.")
-
-    def _validateName(self, name):
-        if name.isalpha():
-            return name
-        else:
-            raise IllegalInput("Given input isn't a name.")
-
-    def _validatePlayer(self, answers):
-        answeredQuestions = []
-        for answer in answers:
-            question = QuestionsForNewPlayer[answer]
-            if question.name in answeredQuestions:
-                raise DoubleInput(f"QUESTION: {question.name} HAS TWO ANSWERS", question)
-            answeredQuestions.append(question.name)
-            givenInput = answers[answer]
-            inputType = InputType[question.value["type"]]
-            isValid = self._validateInput(givenInput, inputType)
-            if not isValid:
-                raise IllegalInput(f"ILLEGAL INPUT: {givenInput} FOR QUESTION: {question.name}", question)
-
-        allQuestions = QuestionsForNewPlayer.getAllLiterals()
-        for question in allQuestions:
-            if question not in answeredQuestions:
-                raise MissingInput(f"MISSING ANSWER FOR QUESTION: {question.name}", question)
-
-    def getFormForNewPlayer(self):
-        response = QuestionsForNewPlayer.getAllValues()
-        return self._reformatJson(response)
-
-    def validateSingleInput(self, data):
-        givenInput = data["givenInput"]
-        inputType = InputType[data["type"]]
-        isValid = self._validateInput(givenInput, inputType)
-
-        if not isValid:
-            if inputType == InputType.PASSWORD:
-                message = "Invalid password"
-            else:
-                message = f"Invalid input: {givenInput} for type: {inputType}"
-            response = {
-                "status": "FAILURE", "message": message
-            }
-            return self._reformatJson(response)
-
-        return self._reformatJson({"status": "SUCCESS"})
-
-    def getPlayerById(self, data):
-        player = self._getPlayerById(data['_id'])
-        return self._reformatJson(player.data)
-
-    def getPlayerByLoginData(self, loginData):
-        player = self._getPlayerByLoginData(loginData)
-        return self._reformatJson(player.data)
-
-    def login(self, loginData):
-        try:
-            self._getPlayerByLoginData(loginData)
-            return self._reformatJson({"status": "SUCCESS"})
-        except PlayerNotFound:
-            return self._reformatJson({"status": "FAILURE", "message": "NO SUCH PLAYER"})
-        except LoginError:
-            return self._reformatJson({"status": "FAILURE", "message": "INCORRECT PASSWORD"})
-
-    def _reformatTime(self, hour):
-        return str(hour).zfill(2) + ":00"
-
-    def createNewPlayer(self, playerData):
-        self._validatePlayer(answers=playerData)
-        playerData["password"] = self._getHashValue(playerData["password"])
-        player = Player(playerData, True)
-        print(f"NEW PLAYER CREATED: {player.data['_id']}")
-        self.players.append(player)
-        PlayersCollection.insert_one(player.data)
-        return self._reformatJson({
-            "status": "SUCCESS",
-            "playerId": player.data["_id"],
-            "name": player.data["name"],
-            "time": self._reformatTime(player.data["time_of_the_day"])
-        })
-
-    def getBasicDetailsForLogin(self, body):
-        try:
-            player = self._getPlayerById(body["playerId"])
-            return self._reformatJson({
-                "status": "SUCCESS",
-                "playerId": player.data["_id"],
-                "name": player.data["name"],
-                "time": self._reformatTime(player.data["time_of_the_day"])
-            })
-        except PlayerNotFound:
-            return self._reformatJson({
-                "status": "FAILURE",
-                "message": f"NO PLAYER WITH ID: f{body['playerId']}"
-            })
-
-    def getRelevantMenu(self, loginData):
-        currentPlayer = self._getPlayerByLoginData(loginData)
-        ADULT_OPTIONS = [ChoiceOptions.LEARN_COOKING, ChoiceOptions.LEARN_GUITAR, ChoiceOptions.PLAY_FOOTBALL,
-                         ChoiceOptions.MEET_FRIENDS, ChoiceOptions.READ_A_BOOK]
-
-        if (currentPlayer.get('time_of_the_day') > 20 or
-                int(currentPlayer.get('age')) < 5):
-            options = [ChoiceOptions.SLEEP]
-        elif int(currentPlayer.get('age')) < 18:
-            options = [ChoiceOptions.GO_TO_SCHOOL]
-        else:
-            options = ADULT_OPTIONS
-
-        optionsForResponse = []
-        for option in options:
-            optionsForResponse.append({
-                "literal": option.name,
-                "string": option.value["string"]
-            })
-
-        response = {
-            "status": "SUCCESS",
-            "name": currentPlayer.get("name"),
-            "time": self._reformatTime(currentPlayer.get("time_of_the_day")),
-            "options": optionsForResponse
-        }
-        return self._reformatJson(response)
-
-    def getPlayerData(self, body):
-        currentPlayer = self._getPlayerById(body['playerId'])
-        return self._reformatJson(currentPlayer.data)
-
-    def _handleAgeEvents(self, player, choice):
-        if ((choice == ChoiceOptions.SLEEP and
-             player.getSkill(choice.value['skill']) % 10 == 0) or
-                (choice == ChoiceOptions.GO_TO_SCHOOL and
-                 player.getSkill(choice['skill']) % 10 == 0)):
-            player.raiseAge(1)
-
-    def _handleDailyBonus(self, player, choice):
-        skills = player.data["skills"]
-        if (choice == ChoiceOptions.SLEEP and
-                player.getSkill(choice.value['skill']) % 7 == 0 and
-                player.get('time_of_the_day') == 8):
-            skillToRaise = random.choice(list(skills))
-            player.raiseSkill(skillToRaise, 1)
-
-    def handleChoice(self, body):
-        currentPlayer = self._getPlayerByLoginData(body['loginData'])
-        choice = ChoiceOptions[body['choice']]
-        currentPlayer.raiseSkill(choice.value['skill'], 1)
-        if choice == ChoiceOptions.SLEEP:
-            currentPlayer.set("time_of_the_day", 8)
-        else:
-            currentPlayer.spendTime(choice.value['timeSpent'])
-
-        # now handling linked events:
-        self._handleAgeEvents(currentPlayer, choice)
-        self._handleDailyBonus(currentPlayer, choice)
-
-        return self._reformatJson({"status": "SUCCESS", "playerData": currentPlayer.data})
-
-
-game = Game()
-app = Flask(__name__)
-
-
-@app.route('/invokeAction/<action>', methods=['GET', 'POST'])
-def invoke_action(action):
-    if request.method == 'POST' and request.json is None:
-        body = json.dumps({"status": "FAILURE", "message": "INVALID FORMAT"}, sort_keys=False)
-        return Response(body, mimetype='text/json')
-    if (not hasattr(game, action)
-            or not isPermitted(action)):
-        body = json.dumps({"status": "FAILURE", "message": f"NO SUCH SERVICE: {action}"}, sort_keys=False)
-        return Response(body, mimetype='text/json')
-
-    content = request.json
-    function = getattr(game, action)
-
-    try:
-        if request.method == 'POST':
-            body = function(content)
-        else:  # GET
-            body = function()
-        return Response(body, mimetype='text/json')
-    except Exception as e:
-        body = json.dumps({"status": "FAILURE", "message": "AN INTERNAL ERROR HAS OCCURRED"}, sort_keys=False)
-        logger.exception(e)
-        return Response(body, mimetype='text/json')
-
-
-def isPermitted(action):
-    # action that start with '_' are internal and aren't meant to be directly invoked.
-    return not action.startswith('_')
-
-
-if __name__ == '__main__':
-    app.run(host='localhost', port='8081', debug=True)
+import random
+from flask import Flask, request, Response
+from enum import Enum
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from array import array
+import json
+import uuid
+import logging
+import threading
+import contextvars
+import atexit
+import time
+import secrets
+import os
+from pymongo import MongoClient, UpdateOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+import datetime
+import hashlib
+import hmac
+import bisect
+import math
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import passwords
+import metrics
+import profiling
+import journal as journaling
+import storage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+logger = logging.getLogger('root')
+FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
+logging.basicConfig(format=FORMAT)
+logger.setLevel(logging.DEBUG)
+
+# GAME_STORAGE picks the players collection (a storage.PlayersStorage): mongo, sqlite keeps the players in
+# an embedded database file (GAME_SQLITE_PATH) and memory in an in-process stand-in (e.g. for load tests)
+STORAGE = os.environ.get("GAME_STORAGE", "mongo")
+if STORAGE == "memory":
+    from memory_collection import MemoryCollection
+    PlayersCollection = MemoryCollection()
+elif STORAGE == "sqlite":
+    from sqlite_collection import SQLiteCollection
+    PlayersCollection = SQLiteCollection(os.environ.get("GAME_SQLITE_PATH", "game.db"))
+else:
+    db = MongoClient('mongodb://localhost:27017/').Game
+    PlayersCollection = db.Player
+
+# Write-behind persistence: when WRITE_BEHIND_INTERVAL is set (seconds), player updates are
+# queued and written in bulk instead of one update per action.
+WRITE_BEHIND_INTERVAL = None
+WRITE_BEHIND_MAX_DIRTY = 500
+writeBehind = None
+
+# per player locks are striped over this many locks
+PLAYER_LOCK_STRIPES = 1024
+
+# Lazy residency: instead of loading every player on startup, players are loaded on first access
+# and kept in a bounded cache (PLAYER_CACHE_TTL is in seconds, None for no expiry).
+LAZY_PLAYERS = False
+PLAYER_CACHE_SIZE = 100000
+PLAYER_CACHE_TTL = 600
+
+# Sessions issued on login, so authenticated actions don't need the password (SESSION_TTL is in seconds).
+SESSION_TTL = 3600
+MAX_SESSIONS = 100000
+
+# Passwords are hashed with a slow KDF on a pool of HASHING_WORKERS processes (None for one per CPU),
+# and credentials that were verified in the last CREDENTIAL_CACHE_TTL seconds aren't hashed again.
+HASHING_WORKERS = None
+CREDENTIAL_CACHE_SIZE = 10000
+CREDENTIAL_CACHE_TTL = 300
+
+# Atomic updates: skill, time and age changes are applied in the DB with $inc/find_one_and_update and
+# the players are refreshed from the returned documents, so several server processes can share the DB.
+# Players created by other processes are loaded on first access, use it with LAZY_PLAYERS (and a short
+# PLAYER_CACHE_TTL) so menus are built from fresh data too. Sessions are still per process.
+ATOMIC_UPDATES = False
+
+# the most actions a single /invokeBatch request can run
+MAX_BATCH_SIZE = 100
+
+# the most players getLeaderboard returns
+MAX_LEADERBOARD_SIZE = 100
+
+# /exportPlayers reads the players from the DB in batches of EXPORT_BATCH_SIZE and writes them in chunks
+# of EXPORT_CHUNK_SIZE lines, so exports take about the same memory whatever the size of the collection.
+# It's for operators: requests have to send EXPORT_TOKEN in the EXPORT_HEADER, and it's off while it's None.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 500
+EXPORT_HEADER = "X-Export-Token"
+EXPORT_TOKEN = None
+
+# Profiling: a PROFILE_SAMPLE_RATE fraction of the actions, and the ones sent with a PROFILE_HEADER that matches
+# PROFILE_TOKEN, run under cProfile. The newest MAX_PROFILES captures are kept in PROFILE_DIR and the getProfiles
+# action (given the PROFILE_TOKEN) lists them along with their hottest functions. PROFILE_TOKEN = None turns
+# the header and getProfiles off.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_TOKEN = None
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), "game-profiles")
+MAX_PROFILES = 100
+
+# Journal persistence: when JOURNAL_DIR is set, players aren't written to the DB. Instead, new players and
+# accepted actions (with the outcome of their random events) are appended to a segmented journal in JOURNAL_DIR,
+# fsynced in groups, and all the players are snapshotted there every SNAPSHOT_INTERVAL seconds and on shutdown.
+# On startup the players are restored from the latest snapshot and the journal after it.
+# It keeps all the players in memory, so it can't be used with LAZY_PLAYERS, ATOMIC_UPDATES or write-behind.
+JOURNAL_DIR = None
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+SNAPSHOT_INTERVAL = 300
+journal = None
+
+
+class GameException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return f"In Game Exception: {self.reason}"
+
+
+class IllegalChoice(GameException):
+    pass
+
+
+class FormException(GameException):
+    # question is the QuestionsForNewPlayer the input was given for, if it's known
+    def __init__(self, reason, question=None):
+        self.reason = reason
+        self.question = question
+
+
+class DoubleInput(FormException):
+    pass
+
+
+class MissingInput(FormException):
+    pass
+
+
+class IllegalInput(FormException):
+    pass
+
+
+class PlayerNotFound(GameException):
+    pass
+
+
+class EnumNotFound(GameException):
+    pass
+
+
+class LoginError(GameException):
+    pass
+
+
+class UsernameIsTaken(FormException):
+    pass
+
+
+class SessionExpired(GameException):
+    pass
+
+
+class Skills(MutableMapping):
+    """
+    The skill levels of a player, kept in a typed array indexed by NAMES instead of a dict.
+    """
+    NAMES = ('study_level', 'music_level', 'sports_level', 'cooking_level', 'social_level',
+             'went_to_school', 'went_to_sleep')
+    INDEXES = {name: index for index, name in enumerate(NAMES)}
+    __slots__ = ('levels',)
+
+    def __init__(self, levels=None):
+        self.levels = array('q', levels if levels is not None else [0] * len(self.NAMES))
+
+    @classmethod
+    def fromDict(cls, skills):
+        return cls([skills.get(name, 0) for name in cls.NAMES])
+
+    def toDict(self):
+        return dict(zip(self.NAMES, self.levels))
+
+    def __getitem__(self, name):
+        return self.levels[self.INDEXES[name]]
+
+    def __setitem__(self, name, level):
+        self.levels[self.INDEXES[name]] = level
+
+    def __delitem__(self, name):
+        raise TypeError("skills can't be removed")
+
+    def __iter__(self):
+        return iter(self.NAMES)
+
+    def __len__(self):
+        return len(self.NAMES)
+
+
+MISSING = object()
+
+
+class PlayerData(MutableMapping):
+    """
+    The fields of a player, kept in slots instead of a dict (fields that aren't known are kept in `extra`).
+    The slots are in the order the fields are stored, so toDict() gives the same document as before.
+    """
+    FIELDS = ('username', 'password', 'name', 'age', 'height', 'city', 'job',
+              '_id', 'time_of_the_day', 'skills', 'creation_time', 'last_update_time', 'version')
+    FIELD_SET = frozenset(FIELDS)
+    # fields that aren't sent to clients in delta responses
+    PRIVATE_FIELDS = frozenset(('password',))
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, fields=()):
+        self.extra = None
+        for key, value in dict(fields).items():
+            self[key] = value
+
+    def toDict(self):
+        document = {}
+        for key in self.FIELDS:
+            value = getattr(self, key, MISSING)
+            if value is not MISSING:
+                document[key] = value.toDict() if key == 'skills' else value
+        if self.extra is not None:
+            document.update(self.extra)
+        return document
+
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'skills' and not isinstance(value, Skills):
+            value = Skills.fromDict(value)
+        if key in self.FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is not None:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if getattr(self, key, MISSING) is not MISSING:
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class Player:
+    __slots__ = ('data', 'pendingSet', 'pendingInc', 'deferredWrites', 'journalSeq')
+
+    def __init__(self, player_data, isNew):
+        self.data = PlayerData(player_data)
+        # changes that weren't written to the DB yet (see updateInDB), None until there are any:
+        self.pendingSet = None
+        self.pendingInc = None
+        self.deferredWrites = 0
+        # the seq number of the last journal entry applied to the player (see JOURNAL_DIR)
+        self.journalSeq = 0
+        if isNew:
+            self.data['_id'] = str(uuid.uuid4())
+            self.data['time_of_the_day'] = 8
+            self.data['skills'] = Skills()
+            self.data['creation_time'] = datetime.datetime.utcnow()
+            self.data['last_update_time'] = datetime.datetime.utcnow()
+            self.data['version'] = 0
+
+    def get(self, attribute):
+        return self.data[attribute]
+
+    def set(self, attribute, value):
+        if ATOMIC_UPDATES:
+            self.updateAtomically({"$set": {attribute: value}})
+            return
+        self.data[attribute] = value
+        self.updateInDB({attribute: value})
+
+    def getSkill(self, skill):
+        return self.data['skills'][skill]
+
+    def raiseSkill(self, skill, by):
+        if ATOMIC_UPDATES:
+            self.updateAtomically({"$inc": {f"skills.{skill}": by}})
+            return
+        self.data['skills'][skill] += by
+        leaderboards.update(self, (skill,))
+        self.updateInDB({}, increments={f"skills.{skill}": by})
+
+    def spendTime(self, by):
+        if ATOMIC_UPDATES:
+            self.updateAtomically({"$inc": {'time_of_the_day': by}})
+            return
+        self.data['time_of_the_day'] += by
+        self.updateInDB({}, increments={'time_of_the_day': by})
+
+    def raiseAge(self, by):
+        # older players have their age stored as a string
+        if ATOMIC_UPDATES and isinstance(self.data['age'], str):
+            self.updateAtomically([{"$set": {"age": {"$add": [{"$toInt": "$age"}, by]}}}])
+            return
+        if ATOMIC_UPDATES:
+            self.updateAtomically({"$inc": {'age': by}})
+            return
+        self.data['age'] = int(self.data['age']) + by
+        leaderboards.update(self, ('age',))
+        self.updateInDB({'age': self.data['age']})
+
+    def raiseVersion(self):
+        # raised once per action, so clients can tell whether their copy of the player is current.
+        # players that were stored before versions were added start from 0.
+        self.data['version'] = self.data.get('version', 0) + 1
+        self.updateInDB({}, increments={'version': 1})
+
+    def updateInDB(self, delta, increments=None):
+        if self.pendingSet is None:
+            self.pendingSet = {}
+            self.pendingInc = {}
+        self.data['last_update_time'] = datetime.datetime.utcnow()
+        self.pendingSet['last_update_time'] = self.data['last_update_time']
+        self._addPending(delta, increments or {})
+
+        if self.deferredWrites == 0:
+            self.flushToDB()
+
+    def _addPending(self, sets, increments):
+        for key, value in sets.items():
+            # a $set overrides any earlier $inc on the same field (or below it)
+            for incKey in [k for k in self.pendingInc if k == key or k.startswith(key + '.')]:
+                del self.pendingInc[incKey]
+            self.pendingSet[key] = value
+        for key, by in increments.items():
+            topLevelKey = key.split('.')[0]
+            if topLevelKey in self.pendingSet:
+                # mongo rejects $set and $inc on the same path, the live value is already up to date
+                self.pendingSet[topLevelKey] = self.data[topLevelKey]
+            else:
+                self.pendingInc[key] = self.pendingInc.get(key, 0) + by
+
+    def updateAtomically(self, update):
+        # applies the update in the DB and refreshes the player from the document it returns,
+        # so changes made by other processes aren't overwritten. update can also be an aggregation pipeline.
+        now = datetime.datetime.utcnow()
+        if isinstance(update, list):
+            update = update + [{"$set": {"last_update_time": now}}]
+        else:
+            update = dict(update, **{"$set": dict(update.get("$set", {}), last_update_time=now)})
+        document = PlayersCollection.find_one_and_update({"_id": self.data["_id"]}, update,
+                                                         return_document=ReturnDocument.AFTER)
+        if document is None:
+            raise PlayerNotFound(f"NO PLAYER WITH ID: {self.data['_id']}")
+        self.data.update(document)
+        leaderboards.update(self)
+
+    def takePendingUpdate(self):
+        # returns the pending changes as a single mongo update, or None if there aren't any
+        pendingSet, self.pendingSet = self.pendingSet, None
+        pendingInc, self.pendingInc = self.pendingInc, None
+        if not pendingSet and not pendingInc:
+            return None
+        update = {}
+        if pendingSet:
+            update["$set"] = {key: value.toDict() if isinstance(value, Skills) else value
+                              for key, value in pendingSet.items()}
+        if pendingInc:
+            update["$inc"] = pendingInc
+        return update
+
+    def restorePendingUpdate(self, update):
+        # puts back an update of takePendingUpdate that wasn't written, the changes made since then are newer
+        newerSet, newerInc = self.pendingSet or {}, self.pendingInc or {}
+        self.pendingSet, self.pendingInc = {}, {}
+        self._addPending(update.get("$set", {}), update.get("$inc", {}))
+        self._addPending(newerSet, newerInc)
+
+    def flushToDB(self):
+        if journal is not None:
+            # the changes are in the journal already
+            self.takePendingUpdate()
+            return
+        if writeBehind is not None:
+            writeBehind.markDirty(self)
+            return
+        update = self.takePendingUpdate()
+        if update is not None:
+            PlayersCollection.update_one({"_id": self.data["_id"]}, update)
+
+    @contextmanager
+    def unitOfWork(self):
+        # all the changes made inside the block are written to the DB in a single update
+        self.deferredWrites += 1
+        try:
+            yield self
+        finally:
+            self.deferredWrites -= 1
+            if self.deferredWrites == 0:
+                self.flushToDB()
+
+
+class InstrumentedCollection:
+    """
+    Wraps the players collection, counting and timing each of its operations by the action they're made for
+    (see dbOperations), so e.g. the updates each action makes can be told apart.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        operation = getattr(self.collection, name)
+        if not callable(operation):
+            return operation
+        if name == "find":
+            # creating the cursor doesn't read anything, its time is the time it takes to iterate it
+            return lambda *args, **kwargs: InstrumentedCursor(operation(*args, **kwargs),
+                                                              (currentAction.get(), name))
+
+        def instrumented(*args, **kwargs):
+            labels = (currentAction.get(), name)
+            start = time.perf_counter()
+            try:
+                return operation(*args, **kwargs)
+            except Exception:
+                dbOperationErrors.inc(labels)
+                raise
+            finally:
+                dbOperations.inc(labels)
+                dbOperationLatency.observe(time.perf_counter() - start, labels)
+        return instrumented
+
+
+class InstrumentedCursor:
+    """
+    Wraps a find() cursor, it's counted as one operation once it's iterated, and timed by the time spent
+    reading its results (not the caller's time between them, e.g. an export writing its chunks).
+    """
+    def __init__(self, cursor, labels):
+        self.cursor = cursor
+        self.labels = labels
+
+    def __getattr__(self, name):
+        # sort(), hint() and batch_size() return the cursor, the wrapper is returned instead
+        method = getattr(self.cursor, name)
+
+        def chained(*args, **kwargs):
+            result = method(*args, **kwargs)
+            return self if result is self.cursor else result
+        return chained
+
+    def __iter__(self):
+        documents = iter(self.cursor)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    document = next(documents)
+                except StopIteration:
+                    return
+                except Exception:
+                    dbOperationErrors.inc(self.labels)
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield document
+        finally:
+            dbOperations.inc(self.labels)
+            dbOperationLatency.observe(elapsed, self.labels)
+
+
+class LockStripes:
+    """
+    A fixed set of locks that keys are spread over, so actions on different keys (mostly) run in parallel
+    while actions on the same key are serialized, without a lock per key.
+    """
+    def __init__(self, size):
+        self.locks = [threading.RLock() for _ in range(size)]
+
+    def lockFor(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+
+class SortedKeys:
+    # a minimal stand-in for sortedcontainers.SortedList when it isn't installed (inserts are O(n))
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+
+    def add(self, key):
+        bisect.insort(self.keys, key)
+
+    def remove(self, key):
+        del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def bisect_left(self, key):
+        return bisect.bisect_left(self.keys, key)
+
+    def __getitem__(self, index):
+        return self.keys[index]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Leaderboards:
+    """
+    The players ordered by each skill and by age, kept as sorted (-score, player id) keys that are updated
+    as players change, so top lists and ranks don't need a sort. Players with the same score share a rank.
+    """
+    BOARDS = Skills.NAMES + ('age',)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuild(())
+
+    @staticmethod
+    def getScore(data, board):
+        # older players have their age stored as a string
+        return int(data['age']) if board == 'age' else data['skills'][board]
+
+    def rebuild(self, players):
+        # players are (player id, scores in the order of BOARDS) pairs
+        scores = dict(players)
+        boards = {board: (SortedList or SortedKeys)((-playerScores[i], playerId)
+                                                    for playerId, playerScores in scores.items())
+                  for i, board in enumerate(self.BOARDS)}
+        with self.lock:
+            self.scores, self.boards = scores, boards
+
+    def loadFromDB(self):
+        # a covered scan of an index per board, so the players' documents aren't read
+        scores = {}
+        for i, board in enumerate(self.BOARDS):
+            field = 'age' if board == 'age' else f"skills.{board}"
+            index = [(field, DESCENDING), ("_id", ASCENDING)]
+            PlayersCollection.create_index(index)
+            for document in PlayersCollection.find({}, {field: 1}).hint(index):
+                playerScores = scores.setdefault(document["_id"], [0] * len(self.BOARDS))
+                if board == 'age':
+                    playerScores[i] = int(document.get('age', 0))
+                else:
+                    playerScores[i] = document.get('skills', {}).get(board, 0)
+        self.rebuild(scores.items())
+
+    def update(self, player, boards=BOARDS):
+        playerId = player.data['_id']
+        with self.lock:
+            playerScores = self.scores.get(playerId)
+            if playerScores is None:
+                playerScores = self.scores[playerId] = [None] * len(self.BOARDS)
+            for board in boards:
+                i = self.BOARDS.index(board)
+                score = self.getScore(player.data, board)
+                if playerScores[i] == score:
+                    continue
+                if playerScores[i] is not None:
+                    self.boards[board].remove((-playerScores[i], playerId))
+                self.boards[board].add((-score, playerId))
+                playerScores[i] = score
+
+    def getTop(self, board, count):
+        # (rank, player id, score) of the first `count` players
+        with self.lock:
+            keys = self.boards[board][:count]
+        top = []
+        for i, (negativeScore, playerId) in enumerate(keys):
+            rank = top[-1][0] if top and top[-1][2] == -negativeScore else i + 1
+            top.append((rank, playerId, -negativeScore))
+        return top
+
+    def getRank(self, board, player):
+        score = self.getScore(player.data, board)
+        with self.lock:
+            return self.boards[board].bisect_left((-score,)) + 1, score
+
+
+class WriteBehindFlusher:
+    """
+    Collects dirty players and writes them to the DB in bulk, either every `interval` seconds
+    or as soon as `maxDirty` players are waiting. Whatever is left is written on shutdown.
+    """
+    def __init__(self, interval, maxDirty):
+        self.interval = interval
+        self.maxDirty = maxDirty
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeUp = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def markDirty(self, player):
+        with self.lock:
+            self.dirty[player.data["_id"]] = player
+            if len(self.dirty) >= self.maxDirty:
+                # flushing on the flusher's thread, the caller may be holding a player lock
+                self.wakeUp.set()
+
+    def flush(self):
+        with self.lock:
+            players, self.dirty = self.dirty, {}
+        updates = []
+        for playerId, player in players.items():
+            with playerLocks.lockFor(playerId):
+                update = player.takePendingUpdate()
+            if update is not None:
+                updates.append((player, update))
+        if not updates:
+            return
+        try:
+            PlayersCollection.bulk_write([UpdateOne({"_id": player.data["_id"]}, update)
+                                          for player, update in updates], ordered=False)
+        except Exception as e:
+            # the updates that weren't written are pending again, so the next flush retries them. an unordered
+            # bulk write reports the ones that failed, the others were written (and $inc mustn't run twice)
+            if isinstance(e, BulkWriteError):
+                updates = [updates[error["index"]] for error in e.details.get("writeErrors", [])]
+            for player, update in updates:
+                with playerLocks.lockFor(player.data["_id"]):
+                    player.restorePendingUpdate(update)
+                self.markDirty(player)
+            raise
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeUp.wait(self.interval)
+            self.wakeUp.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeUp.set()
+        self.thread.join()
+        self.flush()
+
+
+class InputType(Enum):
+    NAME = 1
+    UNSIGNED = 2
+    DOUBLE = 3
+    USERNAME = 4
+    PASSWORD = 5
+
+    def getByLiteral(self, literal):
+        return self[literal]
+
+
+# The rules the answers of each input type are checked against, in order. They're sent to clients with the
+# form for new players so answers can be checked before they're sent, the rules marked "server" depend on the
+# server's state and can only be checked by it (with validateSingleInput). The server checks all the rules anyway.
+INPUT_RULES = {
+    InputType.NAME: (
+        {"rule": "alpha", "message": "Given input isn't a name."},
+    ),
+    InputType.UNSIGNED: (
+        {"rule": "integer", "message": "Given input isn't an integer."},
+        {"rule": "min", "value": 1, "message": "Given input isn't positive."}
+    ),
+    InputType.DOUBLE: (
+        {"rule": "number", "message": "Given input isn't a number."},
+    ),
+    InputType.USERNAME: (
+        {"rule": "alphanumeric", "message": "Given input isn't alphanumeric."},
+        {"rule": "available", "server": True, "message": "Username is already taken"}
+    ),
+    InputType.PASSWORD: (
+        {"rule": "minLength", "value": 7, "message": "Password must contain at least 7 characters"},
+    )
+}
+
+
+def isInteger(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def isNumber(value):
+    try:
+        return math.isfinite(float(value))
+    except ValueError:
+        return False
+
+
+# checks of the rules that don't depend on the server's state, by rule name
+RULE_CHECKS = {
+    "alpha": lambda value, rule: value.isalpha(),
+    "alphanumeric": lambda value, rule: value.isalnum(),
+    "integer": lambda value, rule: isInteger(value),
+    "number": lambda value, rule: isNumber(value),
+    "min": lambda value, rule: int(value) >= rule["value"],
+    "minLength": lambda value, rule: len(value) >= rule["value"]
+}
+
+
+class QuestionsForNewPlayer(Enum):
+    username = {
+        "question": "Choose username:",
+        "type": InputType.USERNAME,
+        "html_type": "text"
+    }
+    password = {
+        "question": "Choose password:",
+        "type": InputType.PASSWORD,
+        "html_type": "password"
+    }
+    name = {
+        "question": "What's your name?",
+        "type": InputType.NAME,
+        "html_type": "text"
+    }
+    age = {
+        "question": "What's your age?",
+        "type": InputType.UNSIGNED,
+        "html_type": "number"
+    }
+    height = {
+        "question": "What's your height (cm)?",
+        "type": InputType.UNSIGNED,
+        "html_type": "number"
+    }
+    city = {
+        "question": "Where do you live?",
+        "type": InputType.NAME,
+        "html_type": "text"
+    }
+    job = {
+        "question": "What is your profession?",
+        "type": InputType.NAME,
+        "html_type": "text"
+    }
+
+    @staticmethod
+    def getAllLiterals():
+        return list(map(lambda q: q.name, QuestionsForNewPlayer))
+
+    @staticmethod
+    def getAllValues():
+        # copies of the values with their literal names and validation rules added, so the enum itself isn't changed
+        return list(map(lambda q: dict(q.value, name=q.name, type=q.value["type"].name,
+                                       validation=INPUT_RULES[q.value["type"]]), QuestionsForNewPlayer))
+
+    def getByLiteral(self, literal):
+        wantedEnum = self[literal]
+        if wantedEnum is None:
+            raise EnumNotFound(f"NO SUCH ENUM: {literal}")
+        return wantedEnum
+
+
+class ChoiceOptions(Enum):
+    SLEEP = {
+        "string": "Sleep",
+        "skill": "went_to_sleep",
+        "timeSpent": 1
+    }
+    GO_TO_SCHOOL = {
+        "string": "Go to school",
+        "skill": "went_to_school",
+        "timeSpent": 8,
+    }
+    LEARN_COOKING = {
+        "string": "Learn cooking",
+        "skill": "cooking_level",
+        "timeSpent": 2
+    }
+    LEARN_GUITAR = {
+        "string": "Learn guitar",
+        "skill": "music_level",
+        "timeSpent": 2
+    }
+    PLAY_FOOTBALL = {
+        "string": "Play football",
+        "skill": "sports_level",
+        "timeSpent": 2
+    }
+    MEET_FRIENDS = {
+        "string": "Meet friends",
+        "skill": "social_level",
+        "timeSpent": 3
+    }
+    READ_A_BOOK = {
+        "string": "Read a book",
+        "skill": "study_level",
+        "timeSpent": 4
+    }
+
+    def getByLiteral(self, literal):
+        wantedEnum = self[literal]
+        if wantedEnum is None:
+            raise EnumNotFound(f"NO SUCH ENUM: {literal}")
+        return wantedEnum
+
+
+class PlayerIndex:
+    """
+    All the players in memory, indexed by id and by username.
+    """
+    def __init__(self):
+        self.playersById = {}
+        self.playersByUsername = {}
+
+    def getById(self, playerId):
+        return self.playersById.get(playerId)
+
+    def getByUsername(self, username):
+        return self.playersByUsername.get(username)
+
+    def add(self, player):
+        # returns the evicted players, like PlayerCache.add (there aren't any)
+        self.playersById[player.data['_id']] = player
+        self.playersByUsername[player.data['username']] = player
+        return ()
+
+    def values(self):
+        return list(self.playersById.values())
+
+    def __len__(self):
+        return len(self.playersById)
+
+
+class PlayerCache:
+    """
+    A bounded PlayerIndex. When it's full the least recently used player is evicted,
+    and players that were loaded more than `ttl` seconds ago are dropped so they're reloaded from the DB.
+    add() returns the players it evicted instead of passing them to onEvict, since it's called with a player's
+    lock held and onEvict takes the evicted player's lock: the caller passes them on once it released its lock.
+    """
+    def __init__(self, maxSize, ttl, onEvict):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.onEvict = onEvict
+        self.entries = OrderedDict()  # player id -> (player, load time)
+        self.idsByUsername = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def getById(self, playerId):
+        expired = None
+        with self.lock:
+            entry = self.entries.get(playerId)
+            if entry is None:
+                self.misses += 1
+                return None
+            player, loadTime = entry
+            if self.ttl is not None and time.monotonic() - loadTime > self.ttl:
+                expired = self._remove(playerId)
+                self.expirations += 1
+                self.misses += 1
+            else:
+                self.entries.move_to_end(playerId)
+                self.hits += 1
+                return player
+        self.onEvict(expired)
+        return None
+
+    def getByUsername(self, username):
+        playerId = self.idsByUsername.get(username)
+        if playerId is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        return self.getById(playerId)
+
+    def add(self, player):
+        evicted = []
+        with self.lock:
+            self.entries[player.data['_id']] = (player, time.monotonic())
+            self.entries.move_to_end(player.data['_id'])
+            self.idsByUsername[player.data['username']] = player.data['_id']
+            while len(self.entries) > self.maxSize:
+                evicted.append(self._remove(next(iter(self.entries))))
+                self.evictions += 1
+        return evicted
+
+    def _remove(self, playerId):
+        player, _ = self.entries.pop(playerId)
+        if self.idsByUsername.get(player.data['username']) == playerId:
+            del self.idsByUsername[player.data['username']]
+        return player
+
+    def values(self):
+        with self.lock:
+            return [player for player, _ in self.entries.values()]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxSize": self.maxSize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+SLEEP_OPTIONS = (ChoiceOptions.SLEEP,)
+SCHOOL_OPTIONS = (ChoiceOptions.GO_TO_SCHOOL,)
+ADULT_OPTIONS = (ChoiceOptions.LEARN_COOKING, ChoiceOptions.LEARN_GUITAR, ChoiceOptions.PLAY_FOOTBALL,
+                 ChoiceOptions.MEET_FRIENDS, ChoiceOptions.READ_A_BOOK)
+
+
+class JsonEncoder(json.JSONEncoder):
+    """
+    Writes Enums as their literal and anything else that isn't JSON (e.g. datetimes) as its string,
+    in the same pass that serializes the rest, without changing the given object.
+    """
+    def default(self, o):
+        return encodeJsonValue(o)
+
+
+def encodeJsonValue(o):
+    if isinstance(o, Enum):
+        return o.name
+    if isinstance(o, (PlayerData, Skills)):
+        return o.toDict()
+    return str(o)
+
+
+jsonEncoder = JsonEncoder(sort_keys=False)
+
+
+def encodeJson(o):
+    # the responses are built without Enums (they're written by name), orjson would write an Enum by its value
+    if orjson is not None:
+        return orjson.dumps(o, default=encodeJsonValue, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return jsonEncoder.encode(o)
+
+
+JSON_MIMETYPE = 'text/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# the formats responses can be sent in, MessagePack is sent to clients that accept it (if it's installed)
+RESPONSE_FORMATS = (JSON_MIMETYPE,) + ((MSGPACK_MIMETYPE,) if msgpack is not None else ())
+# the format of the response to the current request
+responseFormat = contextvars.ContextVar("responseFormat", default=JSON_MIMETYPE)
+
+
+def encodeMsgpackValue(o):
+    if isinstance(o, datetime.datetime):
+        # as MessagePack timestamps, the stored times are naive UTC
+        return msgpack.Timestamp.from_datetime(o if o.tzinfo is not None else
+                                               o.replace(tzinfo=datetime.timezone.utc))
+    return encodeJsonValue(o)
+
+
+def encodeResponse(o):
+    if responseFormat.get() == MSGPACK_MIMETYPE:
+        return msgpack.packb(o, default=encodeMsgpackValue)
+    return encodeJson(o)
+
+
+def getResponseFormat(accept):
+    # accept is the request's Accept header
+    if accept is not None and MSGPACK_MIMETYPE in accept and MSGPACK_MIMETYPE in RESPONSE_FORMATS:
+        return MSGPACK_MIMETYPE
+    return JSON_MIMETYPE
+
+
+def decodeRequest(body, mimetype):
+    # returns None if the body isn't valid in the format it says it's in
+    try:
+        if mimetype == MSGPACK_MIMETYPE:
+            return msgpack.unpackb(body, raw=False) if msgpack is not None else None
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+@contextmanager
+def respondingIn(format):
+    token = responseFormat.set(format)
+    try:
+        yield
+    finally:
+        responseFormat.reset(token)
+
+
+class CachedResponse:
+    """
+    A response that's serialized once, with an ETag so clients can revalidate it.
+    """
+    def __init__(self, body):
+        self.body = body.encode('utf8') if isinstance(body, str) else body
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class VerifiedCredentials:
+    """
+    Recently verified credentials, so logins don't run the slow KDF every time. The credentials are kept
+    as a digest salted with a per process secret, along with the stored hash they were verified against
+    (a changed password invalidates them). Entries expire after `ttl` seconds.
+    """
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.secret = secrets.token_bytes(32)
+        self.entries = OrderedDict()  # key -> (stored hash, expiry time)
+        self.lock = threading.Lock()
+
+    def getKey(self, username, password):
+        return hmac.new(self.secret, f"{username}\0{password}".encode('utf8'), hashlib.sha256).digest()
+
+    def isVerified(self, key, storedHash):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            if entry[1] < time.monotonic() or not hmac.compare_digest(entry[0], storedHash):
+                del self.entries[key]
+                return False
+            return True
+
+    def add(self, key, storedHash):
+        with self.lock:
+            self.entries[key] = (storedHash, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+
+class SessionTable:
+    """
+    Maps opaque session tokens to player ids. A session expires when it isn't used for `ttl` seconds,
+    and the least recently used sessions are dropped when there are more than `maxSize`.
+    """
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.sessions = OrderedDict()  # token -> (player id, expiry time)
+        self.lock = threading.Lock()
+
+    def create(self, playerId):
+        token = secrets.token_urlsafe(32)
+        with self.lock:
+            self.sessions[token] = (playerId, time.monotonic() + self.ttl)
+            while len(self.sessions) > self.maxSize:
+                self.sessions.popitem(last=False)
+        return token
+
+    def resolve(self, token):
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None or session[1] < time.monotonic():
+                self.sessions.pop(token, None)
+                raise SessionExpired("Session is expired or doesn't exist")
+            self.sessions[token] = (session[0], time.monotonic() + self.ttl)
+            self.sessions.move_to_end(token)
+            return session[0]
+
+
+class Game:
+    def __init__(self):
+        if journal is not None and (LAZY_PLAYERS or ATOMIC_UPDATES or writeBehind is not None):
+            raise RuntimeError("JOURNAL_DIR can't be used with LAZY_PLAYERS, ATOMIC_UPDATES or write-behind")
+        if ATOMIC_UPDATES:
+            # other processes create players too, so only the DB can tell whether a username is taken
+            PlayersCollection.create_index("username", unique=True)
+        self.sessions = SessionTable(MAX_SESSIONS, SESSION_TTL)
+        self.verifiedCredentials = VerifiedCredentials(CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL)
+        self._menuOptions = {}
+        for options in (SLEEP_OPTIONS, SCHOOL_OPTIONS, ADULT_OPTIONS):
+            self._menuOptions[options] = [{"literal": option.name, "string": option.value["string"]}
+                                          for option in options]
+        # responses of GET actions that never change, in each of the formats:
+        self._cachedResponses = {
+            "getFormForNewPlayer": self._cacheResponse(QuestionsForNewPlayer.getAllValues())
+        }
+        if LAZY_PLAYERS:
+            # players are loaded from the DB on first access, so the DB has to be indexed for it:
+            PlayersCollection.create_index("username", unique=True)
+            self.players = PlayerCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL, self._onPlayerEvicted)
+        elif journal is not None:
+            self.players = PlayerIndex()
+            self._restoreFromJournal()
+        else:
+            self.players = PlayerIndex()
+            playersData = PlayersCollection.find()
+            for playerData in playersData:
+                self.players.add(Player(playerData, False))
+        if LAZY_PLAYERS:
+            leaderboards.loadFromDB()
+        else:
+            leaderboards.rebuild((player.data['_id'], [Leaderboards.getScore(player.data, board)
+                                                       for board in Leaderboards.BOARDS])
+                                 for player in self.players.values())
+
+    def _loadPlayer(self, query):
+        playerData = PlayersCollection.find_one(query)
+        if playerData is None:
+            return None
+        # the player might have been loaded by another request in the meantime, there should be only one copy
+        evicted = ()
+        with playerLocks.lockFor(playerData['_id']):
+            player = self.players.getById(playerData['_id'])
+            if player is None:
+                player = Player(playerData, False)
+                evicted = self.players.add(player)
+        self._onPlayersEvicted(evicted)
+        return player
+
+    def _restoreFromJournal(self):
+        header, records = journal.readSnapshot()
+        for record in records:
+            player = Player(record["player"], False)
+            player.journalSeq = record["journalSeq"]
+            self.players.add(player)
+        if header is not None:
+            journal.seq = journal.durableSeq = header["seq"]
+        replayed = 0
+        for entry in journal.readEntries(header["segment"] if header is not None else 0):
+            replayed += self._replayEntry(entry)
+        logger.info(f"restored {len(self.players)} players, replayed {replayed} journal entries")
+
+        threading.Thread(target=self._snapshotPeriodically, name="snapshots", daemon=True).start()
+        atexit.register(self._writeSnapshot)
+
+    def _replayEntry(self, entry):
+        # applies a journal entry the way the action applied it, returns whether it was applied
+        if entry["type"] == "create":
+            if self.players.getById(entry["player"]["_id"]) is not None:
+                return False
+            player = Player(entry["player"], False)
+            self.players.add(player)
+        else:
+            player = self.players.getById(entry["playerId"])
+            if player is None:
+                raise RuntimeError(f"journal entry {entry['seq']} is for an unknown player: {entry['playerId']}")
+            if player.journalSeq >= entry["seq"]:
+                # the snapshot has it already
+                return False
+            if entry["type"] == "choice":
+                self._applyChoice(player, ChoiceOptions[entry["choice"]], entry["bonus"])
+            else:  # "set"
+                player.data[entry["field"]] = entry["value"]
+            player.data["last_update_time"] = entry["time"]
+        player.journalSeq = entry["seq"]
+        return True
+
+    def _journal(self, player, entry):
+        # called with the player's lock held, after the entry's changes were applied to it
+        player.journalSeq = journal.append(dict(entry, time=player.data["last_update_time"]))
+
+    def _writeSnapshot(self):
+        def getRecords():
+            for player in self.players.values():
+                with playerLocks.lockFor(player.data["_id"]):
+                    yield {"journalSeq": player.journalSeq, "player": player.data.toDict()}
+        journal.writeSnapshot(getRecords)
+
+    def _snapshotPeriodically(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self._writeSnapshot()
+            except Exception as e:
+                logger.exception(e)
+
+    def _onPlayersEvicted(self, players):
+        # called without a player lock held, see PlayerCache.add
+        for player in players:
+            self._onPlayerEvicted(player)
+
+    def _onPlayerEvicted(self, player):
+        # writing changes that are still pending, so the next load won't get stale data
+        with playerLocks.lockFor(player.data["_id"]):
+            update = player.takePendingUpdate()
+        if update is not None:
+            PlayersCollection.update_one({"_id": player.data["_id"]}, update)
+
+    def _reformatJson(self, dictToFix):
+        # in the format the request asked for, JSON unless it's MessagePack
+        return encodeResponse(dictToFix)
+
+    def _getHashValue(self, string):
+        # hashes new passwords with the slow KDF, on the hashing process pool
+        return hashingPool.submit(passwords.hashPassword, string).result()
+
+    def _verifyPassword(self, player, password):
+        storedHash = player.data["password"]
+        credentialKey = self.verifiedCredentials.getKey(player.data["username"], password)
+        if self.verifiedCredentials.isVerified(credentialKey, storedHash):
+            return True
+
+        if not hashingPool.submit(passwords.verifyPassword, password, storedHash).result():
+            return False
+        if passwords.isLegacyHash(storedHash):
+            # upgrading the old MD5 hash now that we have the password
+            storedHash = self._getHashValue(password)
+            with playerLocks.lockFor(player.data["_id"]):
+                player.set("password", storedHash)
+                if journal is not None:
+                    self._journal(player, {"type": "set", "playerId": player.data["_id"],
+                                           "field": "password", "value": storedHash})
+        self.verifiedCredentials.add(credentialKey, storedHash)
+        return True
+
+    def _getPlayerById(self, id):
+        player = self.players.getById(id)
+        if player is None and (LAZY_PLAYERS or ATOMIC_UPDATES):
+            player = self._loadPlayer({"_id": id})
+        if player is None:
+            raise PlayerNotFound(f"NO PLAYER WITH ID: {id}")
+        return player
+
+    def _getPlayerByLoginData(self, loginData):
+        player = self.players.getByUsername(loginData["username"])
+        if player is None and (LAZY_PLAYERS or ATOMIC_UPDATES):
+            player = self._loadPlayer({"username": loginData["username"]})
+        if (player is not None and
+                self._verifyPassword(player, loginData["password"])):
+            return player
+
+        raise LoginError("Incorrect username/password")
+
+    def _getAuthenticatedPlayer(self, loginData):
+        # authenticated actions get either a session token or a username and password
+        if "sessionToken" in loginData:
+            return self._getPlayerById(self.sessions.resolve(loginData["sessionToken"]))
+        return self._getPlayerByLoginData(loginData)
+
+    def _validateInput(self, input, inputType):
+        if inputType == InputType.NAME:
+            return self._validateName(input)
+        elif inputType == InputType.UNSIGNED:
+            return self._validateUnsign(input)
+        elif inputType == InputType.DOUBLE:
+            return self._validateDouble(input)
+        elif inputType == InputType.USERNAME:
+            return self._validateUsername(input)
+        elif inputType == InputType.PASSWORD:
+            return self._validatePassword(input)
+
+    def _checkRules(self, input, inputType):
+        # the rules of INPUT_RULES that don't need the server's state
+        for rule in INPUT_RULES[inputType]:
+            if not rule.get("server") and not RULE_CHECKS[rule["rule"]](input, rule):
+                raise IllegalInput(rule["message"])
+
+    def _validateUsername(self, username):
+        self._checkRules(username, InputType.USERNAME)
+        if LAZY_PLAYERS or ATOMIC_UPDATES:
+            isTaken = PlayersCollection.find_one({"username": username}, {"_id": 1}) is not None
+        else:
+            isTaken = self.players.getByUsername(username) is not None
+        if isTaken:
+            raise UsernameIsTaken(f"Username {username} is already taken", QuestionsForNewPlayer.username)
+
+        return username
+
+    def _validatePassword(self, password):
+        self._checkRules(password, InputType.PASSWORD)
+        return password
+
+    def _validateUnsign(self, number):
+        self._checkRules(number, InputType.UNSIGNED)
+        return int(number)
+
+    def _validateDouble(self, number):
+        self._checkRules(number, InputType.DOUBLE)
+        return float(number)
+
+    def _validateName(self, name):
+        self._checkRules(name, InputType.NAME)
+        return name
+
+    def _validatePlayer(self, answers):
+        # returns the validated answers (e.g. numbers as ints)
+        answeredQuestions = []
+        validatedAnswers = {}
+        for answer in answers:
+            question = QuestionsForNewPlayer[answer]
+            if question.name in answeredQuestions:
+                raise DoubleInput(f"QUESTION: {question.name} HAS TWO ANSWERS", question)
+            answeredQuestions.append(question.name)
+            givenInput = answers[answer]
+            inputType = question.value["type"]
+            try:
+                isValid = self._validateInput(givenInput, inputType)
+            except FormException as e:
+                if e.question is None:
+                    e.question = question
+                raise
+            if not isValid:
+                raise IllegalInput(f"ILLEGAL INPUT: {givenInput} FOR QUESTION: {question.name}", question)
+            validatedAnswers[answer] = isValid
+
+        allQuestions = QuestionsForNewPlayer.getAllLiterals()
+        for question in allQuestions:
+            if question not in answeredQuestions:
+                raise MissingInput(f"MISSING ANSWER FOR QUESTION: {question}", QuestionsForNewPlayer[question])
+
+        return validatedAnswers
+
+    def getFormForNewPlayer(self):
+        return self._getCachedResponse("getFormForNewPlayer").body
+
+    def validateSingleInput(self, data):
+        givenInput = data["givenInput"]
+        inputType = InputType[data["type"]]
+        try:
+            self._validateInput(givenInput, inputType)
+        except FormException as e:
+            return self._reformatJson({"status": "FAILURE", "message": e.reason})
+
+        return self._reformatJson({"status": "SUCCESS"})
+
+    def getPlayerById(self, data):
+        player = self._getPlayerById(data['_id'])
+        return self._reformatJson(player.data)
+
+    def getPlayerByLoginData(self, loginData):
+        player = self._getAuthenticatedPlayer(loginData)
+        return self._reformatJson(player.data)
+
+    def login(self, loginData):
+        try:
+            player = self._getPlayerByLoginData(loginData)
+            return self._reformatJson({
+                "status": "SUCCESS",
+                "sessionToken": self.sessions.create(player.data["_id"])
+            })
+        except PlayerNotFound:
+            return self._reformatJson({"status": "FAILURE", "message": "NO SUCH PLAYER"})
+        except LoginError:
+            return self._reformatJson({"status": "FAILURE", "message": "INCORRECT PASSWORD"})
+
+    def _cacheResponse(self, response):
+        cachedResponses = {}
+        for format in RESPONSE_FORMATS:
+            with respondingIn(format):
+                cachedResponses[format] = CachedResponse(self._reformatJson(response))
+        return cachedResponses
+
+    def _getCachedResponse(self, action):
+        # in the format of the current request
+        cachedResponses = self._cachedResponses.get(action)
+        return cachedResponses[responseFormat.get()] if cachedResponses is not None else None
+
+    def _reformatTime(self, hour):
+        return str(hour).zfill(2) + ":00"
+
+    def createNewPlayer(self, playerData):
+        try:
+            return self._createNewPlayer(playerData)
+        except FormException as e:
+            return self._reformatJson({
+                "status": "FAILURE",
+                "message": e.reason,
+                "question": e.question.name if e.question is not None else None
+            })
+
+    def _createNewPlayer(self, playerData):
+        playerData = self._validatePlayer(answers=playerData)
+        playerData["password"] = self._getHashValue(playerData["password"])
+        # players with the same username are created one at a time, so only one of them gets it
+        with playerLocks.lockFor(("username", playerData["username"])):
+            self._validateUsername(playerData["username"])
+            player = Player(playerData, True)
+            print(f"NEW PLAYER CREATED: {player.data['_id']}")
+            if journal is not None:
+                # the player is added before its entry is journaled: a snapshot that doesn't include it listed
+                # the players before the add, so it moved to a new segment before the entry was appended
+                evicted = self.players.add(player)
+                player.journalSeq = journal.append({"type": "create", "player": player.data.toDict()})
+            else:
+                try:
+                    PlayersCollection.insert_one(player.data.toDict())
+                except DuplicateKeyError:
+                    # another process took the username after the check (the username index is unique)
+                    raise UsernameIsTaken(f"Username {playerData['username']} is already taken",
+                                          QuestionsForNewPlayer.username)
+                evicted = self.players.add(player)
+            leaderboards.update(player)
+        self._onPlayersEvicted(evicted)
+        return self._reformatJson({
+            "status": "SUCCESS",
+            "playerId": player.data["_id"],
+            "name": player.data["name"],
+            "time": self._reformatTime(player.data["time_of_the_day"]),
+            "sessionToken": self.sessions.create(player.data["_id"])
+        })
+
+    def getBasicDetailsForLogin(self, body):
+        try:
+            player = self._getPlayerById(body["playerId"])
+            return self._reformatJson({
+                "status": "SUCCESS",
+                "playerId": player.data["_id"],
+                "name": player.data["name"],
+                "time": self._reformatTime(player.data["time_of_the_day"])
+            })
+        except PlayerNotFound:
+            return self._reformatJson({
+                "status": "FAILURE",
+                "message": f"NO PLAYER WITH ID: f{body['playerId']}"
+            })
+
+    def getRelevantMenu(self, loginData):
+        currentPlayer = self._getAuthenticatedPlayer(loginData)
+
+        if (currentPlayer.get('time_of_the_day') > 20 or
+                int(currentPlayer.get('age')) < 5):
+            options = SLEEP_OPTIONS
+        elif int(currentPlayer.get('age')) < 18:
+            options = SCHOOL_OPTIONS
+        else:
+            options = ADULT_OPTIONS
+
+        response = {
+            "status": "SUCCESS",
+            "name": currentPlayer.get("name"),
+            "time": self._reformatTime(currentPlayer.get("time_of_the_day")),
+            "options": self._menuOptions[options]
+        }
+        return self._reformatJson(response)
+
+    def getPlayerData(self, body):
+        currentPlayer = self._getPlayerById(body['playerId'])
+        return self._reformatJson(currentPlayer.data)
+
+    def getProfiles(self, body):
+        # the captures of profiled actions (of body["action"] if it's given) and their "top" hottest functions
+        # captures show the server's internals, they're only listed with the PROFILE_TOKEN
+        if not matchesProfileToken(body.get("token", "")):
+            return self._reformatJson({"status": "FAILURE", "message": "NOT PERMITTED"})
+        captures = profiles.list(body.get("action"))
+        sortBy = body.get("sortBy", "totalTime")
+        if sortBy not in profiling.SORT_KEYS:
+            return self._reformatJson({"status": "FAILURE", "message": f"CAN'T SORT BY: {sortBy}"})
+        return self._reformatJson({
+            "status": "SUCCESS",
+            "captures": [{"action": capture["action"], "time": capture["time"]} for capture in captures],
+            "hotFunctions": profiles.getHotFunctions(captures, int(body.get("top", 20)), sortBy)
+        })
+
+    def getCacheStats(self):
+        if LAZY_PLAYERS:
+            stats = self.players.getStats()
+        else:
+            stats = {"size": len(self.players)}
+        return self._reformatJson({"status": "SUCCESS", "stats": stats})
+
+    def getLeaderboard(self, body):
+        # the top players of a board (a skill or "age"), and the rank of the player in loginData if it's given
+        board = body["board"]
+        if board not in Leaderboards.BOARDS:
+            return self._reformatJson({"status": "FAILURE", "message": f"NO SUCH LEADERBOARD: {board}"})
+        count = max(0, min(int(body.get("top", 10)), MAX_LEADERBOARD_SIZE))
+
+        entries = leaderboards.getTop(board, count)
+        names = self._getNames([playerId for _, playerId, _ in entries])
+        top = [{"rank": rank, "username": names[playerId][0], "name": names[playerId][1], "score": score}
+               for rank, playerId, score in entries if playerId in names]
+        response = {"status": "SUCCESS", "board": board, "top": top}
+        if "loginData" in body:
+            player = self._getAuthenticatedPlayer(body["loginData"])
+            response["rank"], response["score"] = leaderboards.getRank(board, player)
+        return self._reformatJson(response)
+
+    def _getNames(self, playerIds):
+        # player id -> (username, name), when players are loaded on demand they're read in one query
+        # rather than loaded (which would push the players that are in use out of the cache)
+        if LAZY_PLAYERS or ATOMIC_UPDATES:
+            documents = PlayersCollection.find({"_id": {"$in": playerIds}}, {"username": 1, "name": 1})
+            return {document["_id"]: (document["username"], document["name"]) for document in documents}
+        names = {}
+        for playerId in playerIds:
+            player = self.players.getById(playerId)
+            if player is not None:
+                names[playerId] = (player.data["username"], player.data["name"])
+        return names
+
+    def _exportPlayers(self, fields=None, after=None, timeRanges=None):
+        # yields the players as NDJSON chunks in _id order, without their private fields.
+        # after is the last _id of an earlier export to resume from, and timeRanges maps
+        # creation_time/last_update_time to (from, to) datetimes (to isn't included), either can be None.
+        query = {}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        for field, (start, end) in (timeRanges or {}).items():
+            bounds = {}
+            if start is not None:
+                bounds["$gte"] = start
+            if end is not None:
+                bounds["$lt"] = end
+            if bounds:
+                query[field] = bounds
+        if fields:
+            # _id is always exported, it's what the next export resumes from
+            projection = dict({field: 1 for field in fields if field not in PlayerData.PRIVATE_FIELDS}, _id=1)
+        else:
+            projection = {field: 0 for field in PlayerData.PRIVATE_FIELDS}
+
+        if journal is not None:
+            # the players are only in memory (and in the journal)
+            cursor = self._findInMemory(query, projection)
+        else:
+            if writeBehind is not None:
+                writeBehind.flush()
+            cursor = PlayersCollection.find(query, projection).sort("_id", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+        lines = []
+        for document in cursor:
+            line = encodeJson(document)
+            lines.append(line.encode('utf8') if isinstance(line, str) else line)
+            if len(lines) == EXPORT_CHUNK_SIZE:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+
+    def _findInMemory(self, query, projection):
+        # like PlayersCollection.find(query, projection).sort("_id"), over the players in memory
+        for player in sorted(self.players.values(), key=lambda player: player.data["_id"]):
+            with playerLocks.lockFor(player.data["_id"]):
+                document = player.data.toDict()
+            if storage.matchesFilter(document, query):
+                yield storage.project(document, projection)
+
+    def _handleAgeEvents(self, player, choice):
+        if ((choice == ChoiceOptions.SLEEP and
+             player.getSkill(choice.value['skill']) % 10 == 0) or
+                (choice == ChoiceOptions.GO_TO_SCHOOL and
+                 player.getSkill(choice.value['skill']) % 10 == 0)):
+            player.raiseAge(1)
+
+    def _handleDailyBonus(self, player, choice, bonus=None):
+        # returns the skill that was raised, if any. bonus is the skill to raise instead of a random one
+        # (when a journaled action is replayed)
+        skills = player.data["skills"]
+        if (choice == ChoiceOptions.SLEEP and
+                player.getSkill(choice.value['skill']) % 7 == 0 and
+                player.get('time_of_the_day') == 8):
+            skillToRaise = bonus if bonus is not None else random.choice(list(skills))
+            player.raiseSkill(skillToRaise, 1)
+            return skillToRaise
+        return None
+
+    def _applyChoice(self, player, choice, bonus=None):
+        # returns the skill raised by the daily bonus, if any
+        with player.unitOfWork():
+            player.raiseVersion()
+            player.raiseSkill(choice.value['skill'], 1)
+            if choice == ChoiceOptions.SLEEP:
+                player.set("time_of_the_day", 8)
+            else:
+                player.spendTime(choice.value['timeSpent'])
+
+            # now handling linked events:
+            self._handleAgeEvents(player, choice)
+            return self._handleDailyBonus(player, choice, bonus)
+
+    def _getDeltaResponse(self, before, player, baseVersion):
+        # the fields the action changed, if the client's copy is the one the action started from,
+        # otherwise the whole state (without the private fields) for the client to resync with
+        after = player.data.toDict()
+        if baseVersion != before.get("version", 0):
+            return {
+                "status": "SUCCESS",
+                "version": after["version"],
+                "playerData": {key: value for key, value in after.items() if key not in PlayerData.PRIVATE_FIELDS}
+            }
+
+        changes = {}
+        for key, value in after.items():
+            if key in PlayerData.PRIVATE_FIELDS:
+                continue
+            if key == "skills":
+                changedSkills = {skill: level for skill, level in value.items()
+                                 if before.get("skills", {}).get(skill) != level}
+                if changedSkills:
+                    changes["skills"] = changedSkills
+            elif before.get(key, MISSING) != value:
+                changes[key] = value
+        return {"status": "SUCCESS", "baseVersion": baseVersion, "version": after["version"], "changes": changes}
+
+    def handleChoice(self, body):
+        # with "delta" set, only the changes to the client's copy of the player (at "baseVersion") are returned
+        currentPlayer = self._getAuthenticatedPlayer(body['loginData'])
+        choice = ChoiceOptions[body['choice']]
+        # actions of the same player are serialized, different players don't wait for each other
+        with playerLocks.lockFor(currentPlayer.data['_id']):
+            before = currentPlayer.data.toDict() if body.get("delta") else None
+            if ATOMIC_UPDATES:
+                # the choice itself is a single atomic update, the linked events are checked against its result
+                update = {"$inc": {f"skills.{choice.value['skill']}": 1, "version": 1}}
+                if choice == ChoiceOptions.SLEEP:
+                    update["$set"] = {"time_of_the_day": 8}
+                else:
+                    update["$inc"]["time_of_the_day"] = choice.value['timeSpent']
+                currentPlayer.updateAtomically(update)
+
+                self._handleAgeEvents(currentPlayer, choice)
+                self._handleDailyBonus(currentPlayer, choice)
+            else:
+                bonus = self._applyChoice(currentPlayer, choice)
+                if journal is not None:
+                    self._journal(currentPlayer, {"type": "choice", "playerId": currentPlayer.data["_id"],
+                                                  "choice": choice.name, "bonus": bonus})
+
+            if before is not None:
+                return self._reformatJson(self._getDeltaResponse(before, currentPlayer, body.get("baseVersion")))
+            return self._reformatJson({"status": "SUCCESS", "playerData": currentPlayer.data})
+
+
+metricsRegistry = metrics.Registry()
+actionRequests = metricsRegistry.counter("game_action_requests_total", "Game actions invoked", ("action",))
+actionErrors = metricsRegistry.counter("game_action_errors_total", "Game actions that failed with an internal error",
+                                       ("action",))
+actionLatency = metricsRegistry.histogram("game_action_duration_seconds", "Time spent in game actions", ("action",))
+dbOperations = metricsRegistry.counter("game_db_operations_total", "Players collection operations",
+                                       ("action", "operation"))
+dbOperationErrors = metricsRegistry.counter("game_db_operation_errors_total",
+                                            "Players collection operations that failed", ("action", "operation"))
+dbOperationLatency = metricsRegistry.histogram("game_db_operation_duration_seconds",
+                                               "Time spent in players collection operations", ("action", "operation"))
+# the action the DB operations are made for, "none" outside of actions (e.g. on startup or by the write-behind)
+currentAction = contextvars.ContextVar("currentAction", default="none")
+PlayersCollection = InstrumentedCollection(PlayersCollection)
+
+playerLocks = LockStripes(PLAYER_LOCK_STRIPES)
+if JOURNAL_DIR is not None:
+    journal = journaling.Journal(JOURNAL_DIR, JOURNAL_SEGMENT_SIZE)
+profiles = profiling.ProfileStore(PROFILE_DIR, MAX_PROFILES)
+profileSampler = random.Random()
+leaderboards = Leaderboards()
+hashingPool = ProcessPoolExecutor(max_workers=HASHING_WORKERS)
+if WRITE_BEHIND_INTERVAL is not None:
+    writeBehind = WriteBehindFlusher(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_DIRTY)
+game = Game()
+app = Flask(__name__)
+
+
+@app.route('/invokeAction/<action>', methods=['GET', 'POST'])
+def invoke_action(action):
+    # requests and responses are JSON, or MessagePack when the Content-Type/Accept headers ask for it
+    format = getResponseFormat(request.headers.get('Accept'))
+    with respondingIn(format):
+        if request.method == 'POST':
+            content = decodeRequest(request.get_data(), request.mimetype)
+            if content is None:
+                return Response(encodeResponse({"status": "FAILURE", "message": "INVALID FORMAT"}), mimetype=format)
+
+        cachedResponse = game._getCachedResponse(action)
+        if request.method == 'GET' and cachedResponse is not None:
+            if cachedResponse.etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = Response(cachedResponse.body, mimetype=format)
+            response.set_etag(cachedResponse.etag)
+            response.vary.add('Accept')
+            return response
+
+        invoke = profileGameAction if shouldProfile(request.headers.get(PROFILE_HEADER)) else invokeGameAction
+        if request.method == 'POST':
+            body = invoke(action, content)
+        else:  # GET
+            body = invoke(action)
+    return Response(body, mimetype=format)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metricsRegistry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/invokeBatch', methods=['POST'])
+def invoke_batch():
+    format = getResponseFormat(request.headers.get('Accept'))
+    with respondingIn(format):
+        body = invokeGameBatch(decodeRequest(request.get_data(), request.mimetype))
+    return Response(body, mimetype=format)
+
+
+@app.route('/exportPlayers', methods=['GET'])
+def export_players():
+    # e.g. /exportPlayers?fields=username,skills&after=<last _id>&createdFrom=2024-01-01&updatedTo=2024-02-01T12:00
+    if EXPORT_TOKEN is None:
+        body = json.dumps({"status": "FAILURE", "message": "NO SUCH SERVICE: exportPlayers"}, sort_keys=False)
+        return Response(body, mimetype='text/json')
+    # compared as bytes, compare_digest doesn't take strings that aren't ASCII
+    if not hmac.compare_digest(request.headers.get(EXPORT_HEADER, "").encode('utf8'), EXPORT_TOKEN.encode('utf8')):
+        body = json.dumps({"status": "FAILURE", "message": "NOT PERMITTED"}, sort_keys=False)
+        return Response(body, mimetype='text/json')
+    try:
+        timeRanges = {field: tuple(parseTime(request.args.get(arg)) for arg in args)
+                      for field, args in EXPORT_TIME_FILTERS.items()}
+    except ValueError:
+        body = json.dumps({"status": "FAILURE", "message": "INVALID FORMAT"}, sort_keys=False)
+        return Response(body, mimetype='text/json')
+    fields = request.args.get("fields")
+    chunks = game._exportPlayers(fields.split(",") if fields else None, request.args.get("after"), timeRanges)
+    return Response(chunks, mimetype='application/x-ndjson')
+
+
+# the query arguments of /exportPlayers that filter by time, as (from, to) per field
+EXPORT_TIME_FILTERS = {
+    "creation_time": ("createdFrom", "createdTo"),
+    "last_update_time": ("updatedFrom", "updatedTo")
+}
+
+
+def parseTime(value):
+    # ISO 8601 times, compared with the stored times in UTC
+    if value is None:
+        return None
+    time = datetime.datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def invokeGameBatch(entries):
+    # runs a list of {"action", "body"} entries in order, and returns their responses as a list.
+    # entries without a body are invoked like GET actions.
+    if (not isinstance(entries, list) or
+            not all(isinstance(entry, dict) and isinstance(entry.get("action"), str) for entry in entries)):
+        return encodeResponse({"status": "FAILURE", "message": "INVALID FORMAT"})
+    if len(entries) > MAX_BATCH_SIZE:
+        return encodeResponse({"status": "FAILURE", "message": f"BATCH IS LIMITED TO {MAX_BATCH_SIZE} ACTIONS"})
+
+    bodies = []
+    for entry in entries:
+        if entry.get("body") is None:
+            body = invokeGameAction(entry["action"])
+        else:
+            body = invokeGameAction(entry["action"], entry["body"])
+        # the actions' responses are already serialized, so they're joined as they are
+        bodies.append(body.encode('utf8') if isinstance(body, str) else body)
+    if responseFormat.get() == MSGPACK_MIMETYPE:
+        # a MessagePack array is its header followed by its items
+        return msgpack.Packer().pack_array_header(len(bodies)) + b"".join(bodies)
+    return b"[" + b",".join(bodies) + b"]"
+
+
+def invokeGameAction(action, *content):
+    # returns the serialized response of a single action, content is given to POST actions only
+    if (not hasattr(game, action)
+            or not isPermitted(action)):
+        return encodeResponse({"status": "FAILURE", "message": f"NO SUCH SERVICE: {action}"})
+
+    function = getattr(game, action)
+    token = currentAction.set(action)
+    start = time.perf_counter()
+    try:
+        return function(*content)
+    except SessionExpired:
+        return encodeResponse({"status": "FAILURE", "message": "SESSION EXPIRED"})
+    except Exception as e:
+        logger.exception(e)
+        actionErrors.inc((action,))
+        return encodeResponse({"status": "FAILURE", "message": "AN INTERNAL ERROR HAS OCCURRED"})
+    finally:
+        currentAction.reset(token)
+        actionRequests.inc((action,))
+        actionLatency.observe(time.perf_counter() - start, (action,))
+
+
+def shouldProfile(token):
+    # token is the value of the PROFILE_HEADER, if it was sent
+    if token is not None and matchesProfileToken(token):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and profileSampler.random() < PROFILE_SAMPLE_RATE
+
+
+def matchesProfileToken(token):
+    # compared as bytes, compare_digest doesn't take strings that aren't ASCII
+    return PROFILE_TOKEN is not None and hmac.compare_digest(str(token).encode('utf8'), PROFILE_TOKEN.encode('utf8'))
+
+
+def profileGameAction(action, *content):
+    # invokeGameAction under the profiler, only actions that exist are captured
+    if not hasattr(game, action) or not isPermitted(action):
+        return invokeGameAction(action, *content)
+    return profiles.run(action, invokeGameAction, action, *content)
+
+
+def isPermitted(action):
+    # action that start with '_' are internal and aren't meant to be directly invoked.
+    return not action.startswith('_')
+
+
+if __name__ == '__main__':
+    # the reloader's parent process imports this module too, and only one process can open the journal
+    app.run(host='localhost', port='8081', debug=True, use_reloader=journal is None)
@@ -0,0 +1,180 @@
+#
+# Offline simulation of the game rules for balancing: a whole population is kept in NumPy arrays and
+# every tick each player makes one choice from their menu, with the same effects and events as Game.handleChoice.
+#
+#   python simulation.py --players 1000000 --ticks 500 --mix READ_A_BOOK=2,MEET_FRIENDS=1 --seed 7
+#   python simulation.py --check-parity    # replays a small simulation through the scalar Game
+#
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+# the scalar Game is only used by the parity check, against the in-memory collection
+os.environ.setdefault("GAME_STORAGE", "memory")
+import server  # noqa: E402
+from server import ChoiceOptions, Skills  # noqa: E402
+
+CHOICES = list(ChoiceOptions)
+SLEEP = CHOICES.index(ChoiceOptions.SLEEP)
+GO_TO_SCHOOL = CHOICES.index(ChoiceOptions.GO_TO_SCHOOL)
+ADULT_CHOICES = np.array([CHOICES.index(option) for option in server.ADULT_OPTIONS])
+# per choice: the index of the skill it raises and the hours it takes
+CHOICE_SKILLS = np.array([Skills.INDEXES[choice.value['skill']] for choice in CHOICES])
+CHOICE_TIME = np.array([choice.value['timeSpent'] for choice in CHOICES])
+SLEEP_SKILL = Skills.INDEXES[ChoiceOptions.SLEEP.value['skill']]
+SCHOOL_SKILL = Skills.INDEXES[ChoiceOptions.GO_TO_SCHOOL.value['skill']]
+
+
+class Population:
+    """
+    The state of a population of players: skills (players x Skills.NAMES), age and time of the day.
+    """
+    def __init__(self, ages, seed=None, mix=None):
+        self.ages = np.asarray(ages, dtype=np.int64).copy()
+        self.skills = np.zeros((len(self.ages), len(Skills.NAMES)), dtype=np.int64)
+        self.times = np.full(len(self.ages), 8, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+        # weights of the adult choices, choices that aren't in the mix get a weight of 1
+        weights = np.array([(mix or {}).get(CHOICES[choice].name, 1.0) for choice in ADULT_CHOICES])
+        self.adultWeights = weights / weights.sum()
+
+    def chooseActions(self):
+        # the same menus as Game.getRelevantMenu
+        sleeps = (self.times > 20) | (self.ages < 5)
+        goesToSchool = ~sleeps & (self.ages < 18)
+        adults = ~sleeps & ~goesToSchool
+        choices = np.full(len(self.ages), SLEEP)
+        choices[goesToSchool] = GO_TO_SCHOOL
+        choices[adults] = self.rng.choice(ADULT_CHOICES, size=int(adults.sum()), p=self.adultWeights)
+        return choices
+
+    def tick(self, choices=None):
+        # applies a choice of every player, returns the choices and which skill each player got as a daily bonus
+        # (-1 for none), so a tick can be replayed through the scalar Game
+        if choices is None:
+            choices = self.chooseActions()
+        players = np.arange(len(self.ages))
+        self.skills[players, CHOICE_SKILLS[choices]] += 1
+        isSleep = choices == SLEEP
+        self.times = np.where(isSleep, 8, self.times + CHOICE_TIME[choices])
+
+        # linked events, checked against the skills after the choice (like _handleAgeEvents/_handleDailyBonus)
+        sleepLevels = self.skills[:, SLEEP_SKILL]
+        schoolLevels = self.skills[:, SCHOOL_SKILL]
+        agesUp = ((isSleep & (sleepLevels % 10 == 0)) |
+                  ((choices == GO_TO_SCHOOL) & (schoolLevels % 10 == 0)))
+        getsBonus = isSleep & (sleepLevels % 7 == 0) & (self.times == 8)
+        self.ages += agesUp
+
+        bonuses = np.full(len(self.ages), -1)
+        bonuses[getsBonus] = self.rng.integers(0, len(Skills.NAMES), size=int(getsBonus.sum()))
+        self.skills[players[getsBonus], bonuses[getsBonus]] += 1
+        return choices, bonuses
+
+    def summary(self):
+        percentiles = [5, 25, 50, 75, 95]
+
+        def describe(values):
+            return dict({"mean": float(values.mean()), "std": float(values.std())},
+                        **{f"p{p}": float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))})
+
+        ages, counts = np.unique(self.ages, return_counts=True)
+        return {
+            "players": len(self.ages),
+            "skills": {name: describe(self.skills[:, index]) for index, name in enumerate(Skills.NAMES)},
+            "age": describe(self.ages),
+            "ageHistogram": {int(age): int(count) for age, count in zip(ages, counts)}
+        }
+
+
+def simulate(players, ticks, minAge, maxAge, mix, seed):
+    rng = np.random.default_rng(seed)
+    population = Population(rng.integers(minAge, maxAge + 1, size=players), seed=rng.integers(2 ** 63), mix=mix)
+    for _ in range(ticks):
+        population.tick()
+    return population
+
+
+class ReplayRandom:
+    # stands in for the random module in server.py, giving the daily bonuses the simulation drew
+    def __init__(self):
+        self.nextChoice = None
+
+    def choice(self, sequence):
+        return self.nextChoice
+
+
+def checkParity(players=200, ticks=300, seed=0):
+    # runs a simulation and replays its choices and bonuses through the scalar Game, one player at a time
+    rng = np.random.default_rng(seed)
+    population = Population(rng.integers(1, 40, size=players), seed=seed)
+    ages = population.ages.copy()
+    game = server.Game()
+    playerIds = []
+    for i, age in enumerate(ages):
+        player = server.Player({"username": f"sim{i}", "password": "", "name": "Sim", "age": int(age)}, True)
+        server.PlayersCollection.insert_one(player.data.toDict())
+        game.players.add(player)
+        playerIds.append(player.data["_id"])
+
+    sessions = [{"sessionToken": game.sessions.create(playerId)} for playerId in playerIds]
+    replayRandom = ReplayRandom()
+    originalRandom, server.random = server.random, replayRandom
+    try:
+        for _ in range(ticks):
+            choices, bonuses = population.tick()
+            for loginData, choice, bonus in zip(sessions, choices, bonuses):
+                menu = json.loads(game.getRelevantMenu(loginData))["options"]
+                if CHOICES[choice].name not in [option["literal"] for option in menu]:
+                    raise AssertionError(f"{CHOICES[choice].name} isn't on the menu: {menu}")
+                # a bonus the game draws when the simulation didn't would raise a skill named None
+                replayRandom.nextChoice = Skills.NAMES[bonus] if bonus >= 0 else None
+                game.handleChoice({"loginData": loginData, "choice": CHOICES[choice].name})
+    finally:
+        server.random = originalRandom
+
+    for index, playerId in enumerate(playerIds):
+        data = game._getPlayerById(playerId).data
+        expected = (list(population.skills[index]), int(population.ages[index]), int(population.times[index]))
+        actual = ([data["skills"][name] for name in Skills.NAMES], int(data["age"]), data["time_of_the_day"])
+        if expected != actual:
+            raise AssertionError(f"player {playerId}: simulation {expected} != game {actual}")
+    print(f"parity OK: {players} players x {ticks} ticks")
+
+
+def parseMix(mix):
+    # "READ_A_BOOK=2,MEET_FRIENDS=1" -> {"READ_A_BOOK": 2.0, "MEET_FRIENDS": 1.0}, the same --mix format as
+    # client/loadgen.py. The server and the client don't import each other, the two copies are kept in sync
+    weights = {}
+    for entry in filter(None, mix.split(",")):
+        literal, weight = entry.split("=")
+        weights[literal.strip()] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates the game rules over a population of players")
+    parser.add_argument("--players", type=int, default=100000)
+    parser.add_argument("--ticks", type=int, default=1000, help="choices per player")
+    parser.add_argument("--min-age", type=int, default=1)
+    parser.add_argument("--max-age", type=int, default=40)
+    parser.add_argument("--mix", type=parseMix, default={}, help="adult choice weights, e.g. READ_A_BOOK=2")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-parity", action="store_true", help="check the rules against the scalar Game")
+    args = parser.parse_args()
+
+    if args.check_parity:
+        checkParity(seed=args.seed)
+        return 0
+
+    population = simulate(args.players, args.ticks, args.min_age, args.max_age, args.mix, args.seed)
+    print(json.dumps(population.summary(), indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
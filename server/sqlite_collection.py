@@ -0,0 +1,241 @@
+#
+# The players collection in an embedded SQLite database (GAME_STORAGE=sqlite), for single node deployments
+# and test runs that shouldn't need a Mongo server:
+#
+#   players(_id TEXT PRIMARY KEY, username TEXT UNIQUE, document TEXT)    WITHOUT ROWID, so rows are in _id order
+#
+# Documents are stored as JSON (datetimes as {"$date": iso}, like the journal's). The database is in WAL mode,
+# so readers don't block the writer, and every thread has a connection of its own. Statements only depend on
+# the shape of a call (the fields and paths are parameters), so the connection's statement cache prepares
+# each of them once. Updates are made in SQL with json_set, without reading the document first,
+# and bulk_write writes all of its updates in one transaction.
+#
+# Queries on _id and username use the table's indexes, queries on other fields scan the documents.
+#
+
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from journal import encodeValue, decodeObject
+from storage import PlayersStorage, DuplicateKeyError, isCondition, matchesFilter, project
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    _id TEXT PRIMARY KEY,
+    username TEXT UNIQUE,
+    document TEXT NOT NULL
+) WITHOUT ROWID
+"""
+# the fields that have a column (and an index) of their own
+COLUMNS = ("_id", "username")
+# the conditions on _id that are evaluated in SQL (an export resumes after an _id)
+SQL_OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+STATEMENT_CACHE_SIZE = 256
+
+
+def encodeDocument(document):
+    return json.dumps(document, default=encodeValue, separators=(",", ":"))
+
+
+def decodeDocument(text):
+    return json.loads(text, object_hook=decodeObject)
+
+
+def jsonPath(path):
+    # "skills.READ_A_BOOK" -> '$."skills"."READ_A_BOOK"'
+    return "$" + "".join(f'."{key}"' for key in path.split('.'))
+
+
+class SQLiteCursor:
+    # the results of a find(), read from the database as they're iterated, batch_size rows at a time
+    def __init__(self, collection, filter, projection):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.sortKey = None
+        self.direction = 1
+        self.batchSize = 1000
+
+    def hint(self, index):
+        return self
+
+    def batch_size(self, size):
+        self.batchSize = size
+        return self
+
+    def sort(self, key, direction=1):
+        self.sortKey, self.direction = key, direction
+        return self
+
+    def __iter__(self):
+        # sorting by _id is done by the primary key, other sorts read all the results first
+        order = self.sortKey == "_id" and self.direction
+        documents = self.collection._select(self.filter, order=order, batchSize=self.batchSize)
+        if self.sortKey is not None and self.sortKey != "_id":
+            documents = sorted(documents, key=lambda document: document.get(self.sortKey),
+                               reverse=self.direction < 0)
+        for document in documents:
+            yield project(document, self.projection)
+
+
+class SQLiteCollection(PlayersStorage):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._transaction() as connection:
+            connection.execute(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # transactions are started explicitly, statements outside of them commit on their own
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30,
+                                         cached_statements=STATEMENT_CACHE_SIZE)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode commits aren't fsynced until a checkpoint, a crash can lose them but not corrupt the DB
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so a read-modify-write can't be interleaved with another writer
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def create_index(self, keys, unique=False, **kwargs):
+        # _id and username are indexed by the table, the other fields aren't indexed
+        return keys if isinstance(keys, str) else "_".join(f"{field}_{direction}" for field, direction in keys)
+
+    def insert_one(self, document):
+        self.insert_many([document])
+
+    def insert_many(self, documents):
+        # all the documents are inserted in one transaction
+        with self._transaction() as connection:
+            try:
+                connection.executemany("INSERT INTO players (_id, username, document) VALUES (?, ?, ?)",
+                                       ((document["_id"], document.get("username"), encodeDocument(document))
+                                        for document in documents))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+
+    def find(self, filter=None, projection=None):
+        return SQLiteCursor(self, filter or {}, projection)
+
+    def find_one(self, filter=None, projection=None):
+        for document in self._select(filter or {}, limit=1):
+            return project(document, projection)
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        return sum(1 for _ in self._select(filter))
+
+    def update_one(self, filter, update):
+        if self._isKeyFilter(filter):
+            return self._connection().execute(*self._updateStatement(filter["_id"], update)).rowcount
+        with self._transaction() as connection:
+            return self._updateFirst(connection, filter, update)
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=False):
+        if return_document and self._isKeyFilter(filter):
+            statement, parameters = self._updateStatement(filter["_id"], update)
+            # the update is only done once all of its rows are fetched
+            rows = self._connection().execute(statement + " RETURNING document", parameters).fetchall()
+            return project(decodeDocument(rows[0][0]), projection) if rows else None
+        with self._transaction() as connection:
+            documents = list(self._select(filter, limit=1))
+            if not documents:
+                return None
+            statement, parameters = self._updateStatement(documents[0]["_id"], update)
+            rows = connection.execute(statement + " RETURNING document", parameters).fetchall()
+            return project(decodeDocument(rows[0][0]) if return_document else documents[0], projection)
+
+    def bulk_write(self, requests, ordered=True):
+        with self._transaction() as connection:
+            for request in requests:
+                if self._isKeyFilter(request._filter):
+                    connection.execute(*self._updateStatement(request._filter["_id"], request._doc))
+                else:
+                    self._updateFirst(connection, request._filter, request._doc)
+
+    def _isKeyFilter(self, filter):
+        return len(filter) == 1 and "_id" in filter and not isCondition(filter["_id"])
+
+    def _updateFirst(self, connection, filter, update):
+        # called in a transaction, for filters that aren't on the _id alone
+        documents = list(self._select(filter, limit=1))
+        if documents:
+            connection.execute(*self._updateStatement(documents[0]["_id"], update))
+        return len(documents)
+
+    def _updateStatement(self, _id, update):
+        # UPDATE players SET document = json_set(document, path, json(value), ..., path, <current> + by, ...)
+        # the paths are parameters, so the statement only changes with the number of fields
+        if isinstance(update, list):
+            raise NotImplementedError("aggregation pipeline updates aren't supported")
+        pairs, parameters = [], []
+        for field, value in update.get("$set", {}).items():
+            pairs.append("?, json(?)")
+            parameters += [jsonPath(field), encodeDocument(value)]
+        for field, by in update.get("$inc", {}).items():
+            pairs.append("?, coalesce(json_extract(document, ?), 0) + ?")
+            parameters += [jsonPath(field), jsonPath(field), by]
+        assignments = [f"document = json_set(document, {', '.join(pairs)})"] if pairs else []
+        if "username" in update.get("$set", {}):
+            assignments.append("username = ?")
+            parameters.append(update["$set"]["username"])
+        if not assignments:
+            return "UPDATE players SET document = document WHERE _id = ?", [_id]
+        return f"UPDATE players SET {', '.join(assignments)} WHERE _id = ?", parameters + [_id]
+
+    def _select(self, filter, order=None, limit=None, batchSize=1000):
+        # yields the documents that match the filter, conditions on the indexed columns are evaluated in SQL
+        # and the rest of them on the documents. order is 1/-1 for _id order.
+        where, parameters = [], []
+        for field in COLUMNS:
+            if field not in filter:
+                continue
+            condition = filter[field]
+            if not isCondition(condition):
+                where.append(f"{field} = ?")
+                parameters.append(condition)
+            elif field == "_id":
+                for op, operand in condition.items():
+                    if op in SQL_OPERATORS:
+                        where.append(f"_id {SQL_OPERATORS[op]} ?")
+                        parameters.append(operand)
+                    elif op == "$in":
+                        where.append(f"_id IN ({', '.join('?' * len(operand))})" if operand else "0")
+                        parameters += operand
+        statement = "SELECT document FROM players"
+        if where:
+            statement += " WHERE " + " AND ".join(where)
+        if order:
+            statement += " ORDER BY _id" + (" DESC" if order < 0 else "")
+
+        # the cursor is closed as soon as the caller is done with it, a pending statement holds a read transaction
+        cursor = self._connection().execute(statement, parameters)
+        found = 0
+        try:
+            while True:
+                rows = cursor.fetchmany(limit or batchSize)
+                if not rows:
+                    return
+                for (text,) in rows:
+                    document = decodeDocument(text)
+                    if matchesFilter(document, filter):
+                        yield document
+                        found += 1
+                        if limit is not None and found >= limit:
+                            return
+        finally:
+            cursor.close()
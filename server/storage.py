@@ -0,0 +1,121 @@
+#
+# The storage interface of the players collection: the part of the pymongo Collection API the server uses,
+# which a pymongo collection implements as is, and the helpers the other implementations share
+# for evaluating queries, projections and updates on documents (dicts) in Python.
+#
+#   GAME_STORAGE=mongo     pymongo.collection.Collection on localhost:27017 (the default)
+#   GAME_STORAGE=sqlite    sqlite_collection.SQLiteCollection, an embedded database file (GAME_SQLITE_PATH)
+#   GAME_STORAGE=memory    memory_collection.MemoryCollection, in-process (e.g. for load tests)
+#
+
+import abc
+import copy
+import operator
+
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError  # noqa: F401 (raised by insert_one when the _id is taken)
+
+MISSING = object()
+# the query operators matchesFilter understands
+OPERATORS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le, "$ne": operator.ne,
+             "$in": lambda value, operand: value in operand}
+
+
+class PlayersStorage(abc.ABC):
+    """
+    A collection of player documents. Queries are a field (or dotted path) -> value or {operator: value},
+    projections include ({field: 1}, _id is always included) or exclude ({field: 0}) fields, and updates
+    are {"$set": {path: value}, "$inc": {path: number}}. find() returns a cursor that supports
+    sort(field, direction), hint(index) and batch_size(size) (which can be ignored) and iteration.
+    """
+    @abc.abstractmethod
+    def create_index(self, keys, unique=False, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    def insert_one(self, document):
+        pass
+
+    @abc.abstractmethod
+    def find(self, filter=None, projection=None):
+        pass
+
+    @abc.abstractmethod
+    def find_one(self, filter=None, projection=None):
+        pass
+
+    @abc.abstractmethod
+    def count_documents(self, filter, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    def update_one(self, filter, update):
+        pass
+
+    @abc.abstractmethod
+    def find_one_and_update(self, filter, update, projection=None, return_document=False):
+        # return_document is pymongo's ReturnDocument (True for the document after the update),
+        # update can be an aggregation pipeline (a list) on Mongo
+        pass
+
+    @abc.abstractmethod
+    def bulk_write(self, requests, ordered=True):
+        # requests are pymongo UpdateOne operations
+        pass
+
+
+PlayersStorage.register(Collection)
+
+
+def getPath(document, path, default=None):
+    for key in path.split('.'):
+        if not isinstance(document, dict) or key not in document:
+            return default
+        document = document[key]
+    return document
+
+
+def setPath(document, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        document = document.setdefault(key, {})
+    document[keys[-1]] = value
+
+
+def isCondition(value):
+    # e.g. {"$gte": 3, "$lt": 5}
+    return isinstance(value, dict) and bool(value) and all(key in OPERATORS for key in value)
+
+
+def matches(value, condition):
+    if not isCondition(condition):
+        return value == condition
+    return value is not None and all(OPERATORS[op](value, operand) for op, operand in condition.items())
+
+
+def matchesFilter(document, filter):
+    return all(matches(getPath(document, field), condition) for field, condition in filter.items())
+
+
+def project(document, projection):
+    # a copy of the document with the projection applied
+    if projection is None:
+        return copy.deepcopy(document)
+    included = [field for field, include in projection.items() if include]
+    if included:
+        projected = {}
+        for field in included + ["_id"]:
+            value = getPath(document, field, MISSING)
+            if value is not MISSING:
+                setPath(projected, field, copy.deepcopy(value))
+        return projected
+    return {field: copy.deepcopy(value) for field, value in document.items() if field not in projection}
+
+
+def applyUpdate(document, update):
+    if isinstance(update, list):
+        raise NotImplementedError("aggregation pipeline updates aren't supported")
+    for field, value in update.get("$set", {}).items():
+        setPath(document, field, copy.deepcopy(value))
+    for field, by in update.get("$inc", {}).items():
+        setPath(document, field, getPath(document, field, 0) + by)